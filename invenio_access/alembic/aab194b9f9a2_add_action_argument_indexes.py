@@ -0,0 +1,50 @@
+# SPDX-FileCopyrightText: 2026 CERN.
+# SPDX-License-Identifier: MIT
+
+"""Add composite action and argument indexes on the grant tables.
+
+The indexes cover the expansion of actions, which filters on the action and
+the argument and reads the exclude flag and the owner. On PostgreSQL they
+are built concurrently, so that the tables are not locked while they are
+built, and also include the primary key.
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "aab194b9f9a2"
+down_revision = "f9843093f686"
+branch_labels = ()
+depends_on = None
+
+INDEXES = (
+    ("access_actionsusers", "user_id"),
+    ("access_actionsroles", "role_id"),
+    ("access_actionssystemroles", "role_name"),
+)
+
+
+def upgrade():
+    """Upgrade database."""
+    # concurrent builds can't run inside a transaction
+    with op.get_context().autocommit_block():
+        for table, owner in INDEXES:
+            op.create_index(
+                op.f(f"ix_{table}_action_argument"),
+                table,
+                ["action", "argument", "exclude", owner],
+                unique=False,
+                postgresql_concurrently=True,
+                postgresql_include=["id"],
+            )
+
+
+def downgrade():
+    """Downgrade database."""
+    with op.get_context().autocommit_block():
+        for table, _ in INDEXES:
+            op.drop_index(
+                op.f(f"ix_{table}_action_argument"),
+                table_name=table,
+                postgresql_concurrently=True,
+            )
@@ -0,0 +1,37 @@
+# SPDX-FileCopyrightText: 2026 CERN.
+# SPDX-License-Identifier: MIT
+
+"""Create the grant changelog table."""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c3a1f0d2e6b4"
+down_revision = "aab194b9f9a2"
+branch_labels = ()
+depends_on = None
+
+
+def upgrade():
+    """Upgrade database."""
+    op.create_table(
+        "access_changelog",
+        sa.Column(
+            "id",
+            sa.BigInteger().with_variant(sa.Integer(), "sqlite"),
+            autoincrement=True,
+            nullable=False,
+        ),
+        sa.Column("action", sa.String(length=80), nullable=False),
+        sa.Column("argument", sa.String(length=255), nullable=True),
+        sa.Column(
+            "created", sa.DateTime(), server_default=sa.func.now(), nullable=False
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_access_changelog")),
+    )
+
+
+def downgrade():
+    """Downgrade database."""
+    op.drop_table("access_changelog")
@@ -0,0 +1,119 @@
+# SPDX-FileCopyrightText: 2026 CERN.
+# SPDX-License-Identifier: MIT
+
+"""Bitset evaluation of permissions.
+
+Every need (users, roles, system roles...) is interned to a dense integer
+id by a :class:`NeedIndex`, and the needs and excludes of each expanded
+action are stored as Python integers used as bitsets. Checking an identity
+against a permission is then a couple of bitwise ``OR`` and ``AND``
+operations instead of set algebra on needs.
+
+The bitsets are kept in memory by the :class:`BitsetEngine` of each
+process. They are validated against the generation of the action, which
+is stored in the shared action cache and renewed whenever the action is
+invalidated, so grant changes made by other processes are taken into
+account.
+"""
+
+import threading
+from collections import OrderedDict, namedtuple
+
+
+class NeedIndex(object):
+    """Interning table mapping needs to dense integer ids."""
+
+    def __init__(self):
+        """Initialize the index."""
+        self._bits = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Return the number of interned needs."""
+        return len(self._bits)
+
+    def bit(self, need):
+        """Return the id of a need, interning it if needed."""
+        bit = self._bits.get(need)
+        if bit is None:
+            with self._lock:
+                bit = self._bits.setdefault(need, len(self._bits))
+        return bit
+
+    def mask(self, needs):
+        """Return the bitset of needs, interning them if needed."""
+        bits = [self.bit(need) for need in needs]
+        if not bits:
+            return 0
+        buffer = bytearray((max(bits) >> 3) + 1)
+        for bit in bits:
+            buffer[bit >> 3] |= 1 << (bit & 7)
+        return int.from_bytes(buffer, "little")
+
+    def provides_mask(self, needs):
+        """Return the bitset of needs provided by an identity.
+
+        Needs which are not interned are not part of any expansion, so they
+        are ignored instead of being interned.
+        """
+        mask = 0
+        get = self._bits.get
+        for need in needs:
+            bit = get(need)
+            if bit is not None:
+                mask |= 1 << bit
+        return mask
+
+
+BitsetExpansion = namedtuple("BitsetExpansion", ["needs", "excludes"])
+"""Needs and excludes of an expanded action as bitsets."""
+
+
+class BitsetEngine(object):
+    """Keep the bitsets of expanded actions of the current process."""
+
+    def __init__(self, max_size=10000):
+        """Initialize the engine.
+
+        :param max_size: Maximum number of expanded actions kept in memory,
+            the least recently used ones are discarded first.
+            (Default: ``10000``)
+        """
+        self.index = NeedIndex()
+        self.max_size = max_size
+        self._expansions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Return the number of expanded actions kept in memory."""
+        return len(self._expansions)
+
+    def compile(self, expansion):
+        """Convert an expansion of needs and excludes to bitsets."""
+        return BitsetExpansion(
+            needs=self.index.mask(expansion.needs),
+            excludes=self.index.mask(expansion.excludes),
+        )
+
+    def get(self, action_key, generation, load):
+        """Get the bitsets of an action.
+
+        :param action_key: The action cache key.
+        :param generation: The current generation of the action.
+        :param load: A function returning the expansion of the action,
+            called if the bitsets of this generation are not in memory.
+        :returns: A :data:`BitsetExpansion`.
+        """
+        entry = self._expansions.get(action_key)
+        if entry is not None and entry[0] == generation:
+            with self._lock:
+                if action_key in self._expansions:
+                    self._expansions.move_to_end(action_key)
+            return entry[1]
+        bits = self.compile(load())
+        with self._lock:
+            self._expansions[action_key] = (generation, bits)
+            self._expansions.move_to_end(action_key)
+            while len(self._expansions) > self.max_size:
+                self._expansions.popitem(last=False)
+        return bits
@@ -4,7 +4,13 @@
 
 """Command line interface for Invenio-Access."""
 
+import csv
+import json
+import pickle
+import time
+from datetime import datetime, timedelta, timezone
 from functools import wraps
+from itertools import islice
 from warnings import warn
 
 import click
@@ -12,9 +18,21 @@ from flask import current_app
 from flask.cli import with_appcontext
 from invenio_accounts.models import Role, User
 from invenio_db import db
+from sqlalchemy import insert
 from werkzeug.local import LocalProxy
 
-from .models import ActionRoles, ActionUsers
+from .models import (
+    AccessChangelog,
+    ActionRoles,
+    ActionSystemRoles,
+    ActionUsers,
+    get_action_cache_key,
+    get_action_cache_keys,
+    log_grant_changes,
+    mark_grants_written,
+)
+from .proxies import current_access
+from .snapshot import build_snapshot
 
 _current_actions = LocalProxy(lambda: current_app.extensions["invenio-access"].actions)
 """Helper proxy to registered actions."""
@@ -83,8 +101,83 @@ option_argument = click.option(
     "-a", "--argument", default=None, help="Value for parameterized action."
 )
 option_action = click.option("--action", callback=process_action, required=True)
-option_user = click.option("--user", callback=process_email, required=True)
-option_role = click.option("--role", callback=process_role, required=True)
+
+
+def option_owners(name, metavar, description):
+    """Decorate a command to accept repeated owners and a file of owners."""
+
+    def decorator(f):
+        f = click.option(
+            f"--{name}-file",
+            "owners_file",
+            type=click.File("r"),
+            default=None,
+            help=f"File with one {description} per line.",
+        )(f)
+        return click.option(
+            f"--{name}",
+            "owners",
+            multiple=True,
+            metavar=metavar,
+            help=f"{description.capitalize()}, can be repeated.",
+        )(f)
+
+    return decorator
+
+
+option_user = option_owners("user", "EMAIL", "user email address")
+option_role = option_owners("role", "ROLE", "role name")
+
+
+def load_owners(type_, owners, owners_file=None):
+    """Resolve the owners given as options or in a file with one query.
+
+    :param type_: The grant type (``"user"`` or ``"role"``).
+    :param owners: The e-mail addresses or role names given as options.
+    :param owners_file: A file with one identifier per line, lines starting
+        with ``#`` are ignored. (Default: ``None``)
+    :returns: The sorted list of owner column values.
+    """
+    owners = set(owners)
+    if owners_file is not None:
+        for line in owners_file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                owners.add(line)
+    if not owners:
+        raise click.UsageError(f"Missing option '--{type_}' or '--{type_}-file'.")
+    resolved = resolve_owners(type_, owners)
+    missing = sorted(owners - resolved.keys())
+    if missing:
+        raise click.BadParameter(
+            f"{type_.capitalize()}(s) not found: {', '.join(missing)}.",
+            param_hint=f"--{type_}",
+        )
+    return sorted(resolved.values())
+
+
+def add_grants(type_, action, argument, exclude, owners):
+    """Grant or deny an action to several owners with one statement.
+
+    Owners that already have the grant are skipped.
+    """
+    argument = argument or getattr(action, "argument", None)
+    argument = None if argument is None else str(argument)
+    new = insert_grants(
+        type_, [(action.value, argument, exclude, owner) for owner in owners]
+    )
+    if new:
+        invalidate_grants([(action.value, argument)])
+
+
+def remove_grants(type_, action, argument, owners):
+    """Remove the grants of an action for several owners with one statement."""
+    model, owner_column = _GRANT_MODELS[type_]
+    model.query_by_action(action, argument=argument).filter(
+        owner_column.in_(owners)
+    ).delete(synchronize_session=False)
+    argument = argument or getattr(action, "argument", None)
+    invalidate_grants([(action.value, argument), (action.value, None)])
 
 
 #
@@ -101,9 +194,11 @@ def access():
 @option_action
 @option_argument
 @commit
-def allow_action_for_user(user, action, argument):
-    """Allow action for user."""
-    db.session.add(ActionUsers.allow(action, argument=argument, user_id=user.id))
+def allow_action_for_user(owners, owners_file, action, argument):
+    """Allow action for users."""
+    add_grants(
+        "user", action, argument, False, load_owners("user", owners, owners_file)
+    )
 
 
 @access.command()
@@ -111,9 +206,11 @@ def allow_action_for_user(user, action, argument):
 @option_action
 @option_argument
 @commit
-def allow_action_for_role(role, action, argument):
-    """Allow action for role."""
-    db.session.add(ActionRoles.allow(action, argument=argument, role_id=role.id))
+def allow_action_for_role(owners, owners_file, action, argument):
+    """Allow action for roles."""
+    add_grants(
+        "role", action, argument, False, load_owners("role", owners, owners_file)
+    )
 
 
 @access.command()
@@ -121,9 +218,9 @@ def allow_action_for_role(role, action, argument):
 @option_action
 @option_argument
 @commit
-def deny_action_for_user(user, action, argument):
-    """Deny an action from a user identified by an email address."""
-    db.session.add(ActionUsers.deny(action, argument=argument, user_id=user.id))
+def deny_action_for_user(owners, owners_file, action, argument):
+    """Deny an action from users identified by an email address."""
+    add_grants("user", action, argument, True, load_owners("user", owners, owners_file))
 
 
 @access.command()
@@ -131,9 +228,9 @@ def deny_action_for_user(user, action, argument):
 @option_action
 @option_argument
 @commit
-def deny_action_for_role(role, action, argument):
-    """Deny an action from role."""
-    db.session.add(ActionRoles.deny(action, argument=argument, role_id=role.id))
+def deny_action_for_role(owners, owners_file, action, argument):
+    """Deny an action from roles."""
+    add_grants("role", action, argument, True, load_owners("role", owners, owners_file))
 
 
 @access.command()
@@ -145,6 +242,8 @@ def remove_action_global(action, argument):
     ActionUsers.query_by_action(action, argument=argument).filter(
         ActionUsers.user_id.is_(None)
     ).delete(synchronize_session=False)
+    argument = argument or getattr(action, "argument", None)
+    invalidate_grants([(action.value, argument), (action.value, None)])
 
 
 @access.command()
@@ -152,11 +251,9 @@ def remove_action_global(action, argument):
 @option_action
 @option_argument
 @commit
-def remove_action_from_user(user, action, argument):
-    """Remove a action for a user."""
-    ActionUsers.query_by_action(action, argument=argument).filter(
-        ActionUsers.user_id == user.id
-    ).delete(synchronize_session=False)
+def remove_action_from_user(owners, owners_file, action, argument):
+    """Remove a action for users."""
+    remove_grants("user", action, argument, load_owners("user", owners, owners_file))
 
 
 @access.command()
@@ -164,11 +261,9 @@ def remove_action_from_user(user, action, argument):
 @option_action
 @option_argument
 @commit
-def remove_action_from_role(role, action, argument):
-    """Remove a action for a role."""
-    ActionRoles.query_by_action(action, argument=argument).filter(
-        ActionRoles.role_id == role.id
-    ).delete(synchronize_session=False)
+def remove_action_from_role(owners, owners_file, action, argument):
+    """Remove a action for roles."""
+    remove_grants("role", action, argument, load_owners("role", owners, owners_file))
 
 
 @access.command(name="list")
@@ -186,33 +281,628 @@ def list_actions():
 @click.option(
     "-r", "--role", multiple=True, default=[], metavar="ROLE", help="Role name(s)."
 )
-def show_actions(email, role):
-    """Show all assigned actions."""
-    if email:
-        actions = (
-            ActionUsers.query.join(ActionUsers.user).filter(User.email.in_(email)).all()
+@click.option(
+    "-s",
+    "--system-role",
+    multiple=True,
+    default=[],
+    metavar="ROLE",
+    help="System role name(s).",
+)
+@click.option("--action", default=None, help="Only show grants of this action.")
+@click.option(
+    "--limit",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Maximum number of grants to show.",
+)
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["text", "json"]),
+    default="text",
+    show_default=True,
+    help="Output format, JSON prints one grant per line.",
+)
+def show_actions(email, role, system_role, action, limit, fmt):
+    """Show all assigned actions.
+
+    Without any owner, all grants of the given ``--action`` are shown.
+    """
+    owners = {"user": email, "role": role, "system_role": system_role}
+    if not any(owners.values()):
+        if action is None:
+            return
+        owners = None
+
+    grants = iter_grants(owners=owners, action=action)
+    for grant in islice(grants, limit):
+        if fmt == "json":
+            click.echo(json.dumps(grant, sort_keys=True))
+            continue
+        argument = "" if grant["argument"] is None else grant["argument"]
+        exclude = "deny" if grant["exclude"] else "allow"
+        click.secho(
+            f"{grant['type']}:{grant['owner']}:{grant['action']}:"
+            f"{argument}:{exclude}",
+            fg="red" if grant["exclude"] else "green",
         )
-        for action in actions:
-            argument = "" if action.argument is None else action.argument
-            exclude = "deny" if action.exclude else "allow"
-            color = "red" if action.exclude else "green"
-            click.secho(
-                f"user:{action.user.email}:{action.action}:{argument}:{exclude}",
-                fg=color,
-            )
 
-    if role:
-        actions = (
-            ActionRoles.query.filter(Role.name.in_(role)).join(ActionRoles.role).all()
+
+#
+# Bulk import/export
+#
+GRANT_FIELDS = ("type", "owner", "action", "argument", "exclude")
+"""Fields of a serialized grant, in the order used for CSV files."""
+
+_GRANT_MODELS = {
+    "user": (ActionUsers, ActionUsers.user_id),
+    "role": (ActionRoles, ActionRoles.role_id),
+    "system_role": (ActionSystemRoles, ActionSystemRoles.role_name),
+}
+"""Map a grant type to its model and owner column."""
+
+option_format = click.option(
+    "-f",
+    "--format",
+    "fmt",
+    type=click.Choice(["jsonl", "csv"]),
+    default="jsonl",
+    show_default=True,
+    help="Serialization format of the grants.",
+)
+option_chunk_size = click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+    help="Number of grants fetched or written per round trip.",
+)
+
+
+def iter_grants(chunk_size=1000, owners=None, action=None):
+    """Stream grants from the three grant tables.
+
+    Owners are resolved to e-mail addresses, role names and system role
+    names so that the grants can be loaded into another instance. Only the
+    needed columns are selected, so no model instance is ever loaded.
+
+    :param chunk_size: Number of rows fetched per round trip.
+    :param owners: A dictionary mapping grant types to the e-mail addresses,
+        role names or system role names to restrict the grants to. Grant
+        types missing from the dictionary are skipped. If ``None``, grants of
+        all owners are returned. (Default: ``None``)
+    :param action: Restrict the grants to this action name.
+        (Default: ``None``)
+    :returns: An iterator of grant dictionaries.
+    """
+    owner_columns = {
+        "user": (User.email, (User, ActionUsers.user_id == User.id)),
+        "role": (Role.name, (Role, ActionRoles.role_id == Role.id)),
+        "system_role": (ActionSystemRoles.role_name, None),
+    }
+    for type_, (model, _) in _GRANT_MODELS.items():
+        if owners is not None and not owners.get(type_):
+            continue
+        owner_column, join = owner_columns[type_]
+        query = db.session.query(
+            model.action, model.argument, model.exclude, owner_column
         )
-        for action in actions:
-            argument = "" if action.argument is None else action.argument
-            exclude = "deny" if action.exclude else "allow"
-            color = "red" if action.exclude else "green"
-            click.secho(
-                f"role:{action.role.name}:{action.action}:{argument}:{exclude}",
-                fg=color,
+        if join is not None:
+            query = query.join(*join)
+        if owners is not None:
+            query = query.filter(owner_column.in_(owners[type_]))
+        if action is not None:
+            query = query.filter(model.action == action)
+        query = query.order_by(model.id).yield_per(chunk_size)
+        for action_, argument, exclude, owner in query:
+            yield {
+                "type": type_,
+                "owner": owner,
+                "action": action_,
+                "argument": argument,
+                "exclude": bool(exclude),
+            }
+
+
+def write_grants(grants, stream, fmt="jsonl"):
+    """Write grants to a stream.
+
+    :param grants: An iterable of grant dictionaries.
+    :param stream: A writable text stream.
+    :param fmt: Either ``"jsonl"`` or ``"csv"``. (Default: ``"jsonl"``)
+    :returns: The number of written grants.
+    """
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(stream)
+        writer.writerow(GRANT_FIELDS)
+        for grant in grants:
+            row = dict(grant, exclude=int(grant["exclude"]))
+            writer.writerow(["" if row[f] is None else row[f] for f in GRANT_FIELDS])
+            count += 1
+    else:
+        for grant in grants:
+            stream.write(json.dumps(grant, sort_keys=True) + "\n")
+            count += 1
+    return count
+
+
+def read_grants(stream, fmt="jsonl"):
+    """Read grants from a stream.
+
+    :param stream: A readable text stream.
+    :param fmt: Either ``"jsonl"`` or ``"csv"``. (Default: ``"jsonl"``)
+    :returns: An iterator of grant dictionaries.
+    """
+    if fmt == "csv":
+        for row in csv.DictReader(stream):
+            yield {
+                "type": row["type"],
+                "owner": row["owner"],
+                "action": row["action"],
+                "argument": row.get("argument") or None,
+                "exclude": row.get("exclude", "0").strip().lower()
+                in ("1", "true", "deny"),
+            }
+    else:
+        for line in stream:
+            line = line.strip()
+            if line:
+                grant = json.loads(line)
+                grant.setdefault("argument", None)
+                grant["exclude"] = bool(grant.get("exclude", False))
+                yield grant
+
+
+def resolve_owners(type_, owners):
+    """Resolve owner identifiers to the values stored in the grant tables.
+
+    E-mail addresses and role names are resolved with a single ``IN`` query,
+    system role names are checked against the registered system roles.
+
+    :param type_: The grant type (``"user"``, ``"role"`` or
+        ``"system_role"``).
+    :param owners: An iterable of e-mail addresses, role names or system
+        role names.
+    :returns: A dictionary mapping the identifiers that were found to the
+        owner column values.
+    """
+    owners = set(owners)
+    if not owners:
+        return {}
+    if type_ == "user":
+        query = db.session.query(User.email, User.id).filter(User.email.in_(owners))
+    elif type_ == "role":
+        query = db.session.query(Role.name, Role.id).filter(Role.name.in_(owners))
+    else:
+        return {o: o for o in owners if o in current_access.system_roles}
+    return dict(query)
+
+
+def invalidate_grants(keys):
+    """Invalidate the action cache entries of ``(action, argument)`` pairs.
+
+    The changes are also logged in the grant changelog, in the current
+    transaction, so it must be called before the changes are committed.
+    """
+    keys = set(keys)
+    mark_grants_written(db.session)
+    log_grant_changes(db.session, keys)
+    for action, argument in keys:
+        current_access.delete_action_cache(get_action_cache_key(action, argument))
+
+
+def insert_grants(type_, rows, skip_existing=True):
+    """Insert new grant rows of the given type in one statement.
+
+    The caller is responsible for committing the transaction and
+    invalidating the action cache.
+
+    :param type_: The grant type.
+    :param rows: A list of ``(action, argument, exclude, owner)`` tuples where
+        the owner is the owner column value.
+    :param skip_existing: If ``True``, rows that already exist are looked up
+        with one query and skipped. (Default: ``True``)
+    :returns: The list of inserted tuples.
+    """
+    model, owner_column = _GRANT_MODELS[type_]
+    rows = set(rows)
+    if not rows:
+        return []
+    existing = set()
+    if skip_existing:
+        existing = set(
+            db.session.query(
+                model.action, model.argument, model.exclude, owner_column
+            ).filter(
+                owner_column.in_({row[3] for row in rows}),
+                model.action.in_({row[0] for row in rows}),
             )
+        )
+    new = sorted(rows - existing, key=lambda r: tuple(map(str, r)))
+    if new:
+        db.session.execute(
+            insert(model),
+            [
+                {
+                    "action": action,
+                    "argument": argument,
+                    "exclude": exclude,
+                    owner_column.key: owner,
+                }
+                for action, argument, exclude, owner in new
+            ],
+        )
+    return new
+
+
+def resolve_grants(grants, chunk_size=1000, missing=None):
+    """Resolve the owners of grants in chunks.
+
+    :param grants: An iterable of grant dictionaries.
+    :param chunk_size: Number of grants resolved per query.
+    :param missing: A set collecting the ``(type, owner)`` pairs that could
+        not be resolved. (Default: ``None``)
+    :returns: An iterator of ``(size, rows)`` tuples, one per chunk, where
+        ``size`` is the number of grants read and ``rows`` maps each grant
+        type to a list of ``(action, argument, exclude, owner)`` tuples.
+    """
+    missing = set() if missing is None else missing
+    grants = iter(grants)
+    while True:
+        chunk = list(islice(grants, chunk_size))
+        if not chunk:
+            break
+        by_type = {}
+        for grant in chunk:
+            if grant["type"] not in _GRANT_MODELS:
+                raise click.BadParameter(f"Unknown grant type '{grant['type']}'.")
+            by_type.setdefault(grant["type"], []).append(grant)
+
+        rows = {}
+        for type_, type_grants in by_type.items():
+            owners = resolve_owners(type_, (g["owner"] for g in type_grants))
+            for grant in type_grants:
+                if grant["owner"] not in owners:
+                    missing.add((type_, grant["owner"]))
+                    continue
+                argument = grant["argument"]
+                rows.setdefault(type_, []).append(
+                    (
+                        grant["action"],
+                        None if argument is None else str(argument),
+                        grant["exclude"],
+                        owners[grant["owner"]],
+                    )
+                )
+        yield len(chunk), rows
+
+
+def import_grants(grants, chunk_size=1000):
+    """Import grants, committing once per chunk.
+
+    :param grants: An iterable of grant dictionaries.
+    :param chunk_size: Number of grants written per transaction.
+    :returns: A tuple ``(read, inserted, missing)`` where ``missing`` is the
+        set of ``(type, owner)`` pairs that could not be resolved.
+    """
+    read = inserted = 0
+    missing = set()
+    for size, rows in resolve_grants(grants, chunk_size, missing):
+        read += size
+        changed = []
+        for type_, type_rows in rows.items():
+            new = insert_grants(type_, type_rows)
+            inserted += len(new)
+            changed.extend((row[0], row[1]) for row in new)
+        invalidate_grants(changed)
+        db.session.commit()
+    return read, inserted, missing
+
+
+def load_current_grants(chunk_size=1000):
+    """Load the grants of the three tables in one streaming pass.
+
+    :param chunk_size: Number of rows fetched per round trip.
+    :returns: A dictionary mapping ``(type, action, argument, exclude,
+        owner)`` tuples to the primary key of the row, where the owner is the
+        owner column value.
+    """
+    current = {}
+    for type_, (model, owner_column) in _GRANT_MODELS.items():
+        query = db.session.query(
+            model.id, model.action, model.argument, model.exclude, owner_column
+        )
+        for id_, action, argument, exclude, owner in query.yield_per(chunk_size):
+            current[(type_, action, argument, bool(exclude), owner)] = id_
+    return current
+
+
+def sync_grants(grants, chunk_size=1000, dry_run=False):
+    """Make the grant tables match the desired grants.
+
+    Only the difference between the current and the desired state is
+    written, and only the action cache entries of the changed grants are
+    invalidated and logged, once, before the commit.
+
+    :param grants: An iterable of the desired grant dictionaries.
+    :param chunk_size: Number of rows per statement.
+    :param dry_run: If ``True``, compute the difference without applying it.
+        (Default: ``False``)
+    :returns: A tuple ``(to_insert, to_delete, unchanged, missing)`` where
+        ``to_insert`` and ``to_delete`` are sets of grant tuples.
+    """
+    current = load_current_grants(chunk_size=chunk_size)
+
+    desired, missing = set(), set()
+    for _, rows in resolve_grants(grants, chunk_size, missing):
+        for type_, type_rows in rows.items():
+            desired.update((type_,) + row for row in type_rows)
+
+    to_insert = desired - current.keys()
+    to_delete = current.keys() - desired
+    unchanged = len(desired) - len(to_insert)
+    if dry_run or not (to_insert or to_delete):
+        return to_insert, to_delete, unchanged, missing
+
+    for type_, (model, owner_column) in _GRANT_MODELS.items():
+        ids = sorted(current[grant] for grant in to_delete if grant[0] == type_)
+        for start in range(0, len(ids), chunk_size):
+            db.session.query(model).filter(
+                model.id.in_(ids[start : start + chunk_size])
+            ).delete(synchronize_session=False)
+        rows = [grant[1:] for grant in to_insert if grant[0] == type_]
+        for start in range(0, len(rows), chunk_size):
+            insert_grants(type_, rows[start : start + chunk_size], skip_existing=False)
+    invalidate_grants(grant[1:3] for grant in to_insert | to_delete)
+    db.session.commit()
+    return to_insert, to_delete, unchanged, missing
+
+
+def _echo_throughput(verb, count, start):
+    """Report the number of processed grants and the throughput."""
+    elapsed = max(time.monotonic() - start, 1e-9)
+    click.secho(
+        f"{verb} {count} grants in {elapsed:.2f}s ({count / elapsed:.0f} grants/s).",
+        fg="green",
+        err=True,
+    )
+
+
+@access.command(name="export")
+@option_format
+@option_chunk_size
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("w"),
+    default="-",
+    help="Output file (default: standard output).",
+)
+def export_grants(fmt, chunk_size, output):
+    """Export all user, role and system role grants."""
+    start = time.monotonic()
+    count = write_grants(iter_grants(chunk_size=chunk_size), output, fmt=fmt)
+    _echo_throughput("Exported", count, start)
+
+
+@access.command(name="import")
+@option_format
+@option_chunk_size
+@click.argument("source", type=click.File("r"), default="-")
+def import_grants_command(fmt, chunk_size, source):
+    """Import grants previously written by ``export``."""
+    start = time.monotonic()
+    read, inserted, missing = import_grants(
+        read_grants(source, fmt=fmt), chunk_size=chunk_size
+    )
+    for type_, owner in sorted(missing):
+        click.secho(f"Skipped grants of unknown {type_} '{owner}'.", fg="yellow")
+    _echo_throughput("Imported", inserted, start)
+    if read != inserted:
+        click.secho(
+            f"{read - inserted} grants were already present or skipped.", err=True
+        )
+
+
+@access.command(name="sync")
+@option_format
+@option_chunk_size
+@click.option(
+    "--dry-run", is_flag=True, default=False, help="Only show what would change."
+)
+@click.argument("source", type=click.File("r"))
+def sync_grants_command(fmt, chunk_size, dry_run, source):
+    """Make the grants match the desired state described in a file.
+
+    All grants that are not listed in the file are removed.
+    """
+    to_insert, to_delete, unchanged, missing = sync_grants(
+        read_grants(source, fmt=fmt), chunk_size=chunk_size, dry_run=dry_run
+    )
+    for type_, owner in sorted(missing):
+        click.secho(f"Skipped grants of unknown {type_} '{owner}'.", fg="yellow")
+    prefix = "Would apply" if dry_run else "Applied"
+    click.secho(
+        f"{prefix} {len(to_insert)} inserts and {len(to_delete)} deletes "
+        f"({unchanged} grants unchanged).",
+        fg="green",
+    )
+
+
+#
+# Action cache
+#
+@access.group(name="cache")
+def action_cache():
+    """Action cache commands."""
+
+
+option_cache_actions = click.option(
+    "--action",
+    "actions",
+    multiple=True,
+    metavar="ACTION",
+    help="Action name, can be repeated (default: all registered actions).",
+)
+
+
+@action_cache.command("warm")
+@option_cache_actions
+def cache_warm(actions):
+    """Precompute and cache the expansions of actions."""
+    count = current_access.warm_up(actions or "*")
+    click.secho(
+        f"Cached {count} entries in {current_access.warmup_duration:.2f}s.",
+        fg="green",
+    )
+
+
+@action_cache.command("stats")
+@option_cache_actions
+def cache_stats(actions):
+    """Show statistics about the cached actions."""
+    keys = get_action_cache_keys(actions or _current_actions.keys())
+    values = current_access.get_many_action_cache(keys, count=False, raw=True)
+    sizes = {
+        key: len(value) if isinstance(value, bytes) else len(pickle.dumps(value))
+        for key, value in zip(keys, values)
+        if value is not None
+    }
+    click.echo(f"Entries: {len(sizes)} cached out of {len(keys)} known keys.")
+    if sizes:
+        largest = max(sizes, key=sizes.get)
+        click.echo(
+            f"Size: {sum(sizes.values())} bytes in total, "
+            f"largest {sizes[largest]} bytes ({largest})."
+        )
+
+    # decoding the entries measures their decompression
+    serializer = current_access.serializer
+    before = dict(getattr(serializer, "stats", {}))
+    for value in values:
+        if value is not None:
+            serializer.loads(value)
+    after = getattr(serializer, "stats", {})
+    measured = {k: after[k] - before.get(k, 0) for k in after}
+    if measured.get("decompressions"):
+        ratio = measured["decompressed_bytes"] / measured["compressed_bytes"]
+        click.echo(
+            f"Compressed: {measured['decompressions']} entries, "
+            f"ratio {ratio:.1f}x, decompression "
+            f"{1000 * measured['decompression_seconds']:.2f}ms in total."
+        )
+
+    stats = current_access.get_action_cache_stats()
+    lookups = stats.get("hits", 0) + stats.get("misses", 0)
+    hit_rate = f"{100.0 * stats.get('hits', 0) / lookups:.1f}%" if lookups else "n/a"
+    click.echo(
+        f"Hits: {stats.get('hits', 0)}, misses: {stats.get('misses', 0)}, "
+        f"hit rate: {hit_rate}."
+    )
+
+
+@action_cache.command("flush")
+@option_cache_actions
+def cache_flush(actions):
+    """Invalidate the cached expansions of actions and their arguments."""
+    keys = get_action_cache_keys(actions or _current_actions.keys())
+    for key in keys:
+        current_access.delete_action_cache(key)
+    click.secho(f"Invalidated {len(keys)} entries.", fg="green")
+
+
+@action_cache.command("sync")
+def cache_sync():
+    """Invalidate the cached expansions changed since the last sync."""
+    count = current_access.apply_changelog()
+    click.secho(f"Applied {count} grant changes.", fg="green")
+
+
+@action_cache.command("inspect")
+@click.argument("key")
+def cache_inspect(key):
+    """Show the needs and excludes cached under an action key.
+
+    The key is the action name, followed by ``::`` and the argument for
+    parameterized actions.
+    """
+    data = current_access.get_many_action_cache([key], count=False)[0]
+    if data is None:
+        raise click.ClickException(f"No cache entry for '{key}'.")
+    for label, needs in (("need", data.needs), ("exclude", data.excludes)):
+        for need in sorted(needs, key=repr):
+            click.echo(f"{label}:{need.method}:{need.value}")
+
+
+#
+# Grant snapshot
+#
+@access.group(name="snapshot")
+def grant_snapshot():
+    """Grant snapshot commands."""
+
+
+@grant_snapshot.command("build")
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Path of the snapshot (default: ACCESS_SNAPSHOT_PATH).",
+)
+def snapshot_build(output):
+    """Write a snapshot of all the grants to a file."""
+    output = output or current_app.config.get("ACCESS_SNAPSHOT_PATH")
+    if not output:
+        raise click.UsageError("No --output given and no ACCESS_SNAPSHOT_PATH set.")
+    start = time.monotonic()
+    entries, size = build_snapshot(
+        output, overlap=current_app.config.get("ACCESS_REPLICA_POLL_OVERLAP", 1000)
+    )
+    click.secho(
+        f"Wrote {entries} entries ({size} bytes) to {output} "
+        f"in {time.monotonic() - start:.2f}s.",
+        fg="green",
+    )
+
+
+#
+# Grant changelog
+#
+@access.group(name="changelog")
+def grant_changelog():
+    """Grant changelog commands."""
+
+
+@grant_changelog.command("prune")
+@click.option(
+    "--keep",
+    type=click.IntRange(min=0),
+    help="Number of sequence numbers to keep before the last change.",
+)
+@click.option(
+    "--older-than",
+    type=click.IntRange(min=0),
+    help="Only delete the changes logged more than this number of days ago.",
+)
+@commit
+def changelog_prune(keep, older_than):
+    """Delete the old changes from the grant changelog.
+
+    The changes matching all the given options are deleted. Keep the
+    changes logged since the oldest grant snapshot in use was built, since
+    the last cache sync, and at least ACCESS_REPLICA_POLL_OVERLAP sequence
+    numbers.
+    """
+    if keep is None and older_than is None:
+        raise click.UsageError("Give --keep, --older-than or both.")
+    before = None
+    if older_than is not None:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        before = now - timedelta(days=older_than)
+    count = AccessChangelog.prune(keep=keep, before=before)
+    click.secho(f"Deleted {count} grant changes.", fg="green")
 
 
 ################################
@@ -405,4 +1095,6 @@ def process_remove_action(processors, action, argument):
     """Process action removals."""
     for processor in processors:
         processor(action, argument)
+    argument = argument or getattr(action, "argument", None)
+    invalidate_grants([(action.value, argument), (action.value, None)])
     db.session.commit()
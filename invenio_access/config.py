@@ -16,5 +16,130 @@ ACCESS_CACHE = None
 ACCESS_ACTION_CACHE_PREFIX = "Permission::action::"
 """Prefix for actions cached when used in dynamic permissions."""
 
+ACCESS_ACTION_CACHE_SERIALIZER = (
+    "invenio_access.serializers:CompactActionCacheSerializer"
+)
+"""Serializer of the action cache entries.
+
+A serializer class or instance, or an importable string pointing to one. The
+default stores user ids as packed integer arrays and the other needs as JSON,
+so the cache backend does not need to pickle large sets. Use
+:class:`invenio_access.serializers.ActionCacheSerializer` to store the
+expansions as they are.
+"""
+
+ACCESS_ACTION_CACHE_COMPRESSION = None
+"""Compression of large action cache entries: ``"zlib"``, ``"lzma"`` or ``None``.
+
+Only used by the compact serializer. Actions expanding to tens of thousands of
+needs produce multi-megabyte values, which may exceed the value size limit of
+the cache or evict other entries.
+"""
+
+ACCESS_ACTION_CACHE_COMPRESSION_THRESHOLD = 64 * 1024
+"""Minimum size in bytes of an action cache entry to compress it."""
+
+ACCESS_ACTION_CACHE_STATS = False
+"""Share the action cache hit/miss counters of all processes in the cache.
+
+Counting costs one extra cache round trip per action lookup, so it is
+disabled by default. The counters are shown by ``invenio access cache stats``.
+"""
+
+ACCESS_WARMUP_ACTIONS = []
+"""Actions to preload into the action cache before the first request.
+
+A list of action names, or ``"*"`` for all the registered actions. The
+actions and all their arguments are expanded with one query per grant table.
+The duration of the warm-up is logged and kept in
+``current_access.warmup_duration``.
+"""
+
+ACCESS_BITSET_EVALUATION = False
+"""Evaluate permissions with bitsets.
+
+Needs are interned to integer ids and the expansions of actions are kept in
+each process as bitsets, so that checking an identity is a few bitwise
+operations. The bitsets are validated against the action generations stored
+in the cache, so it requires ``ACCESS_CACHE``.
+"""
+
+ACCESS_BITSET_CACHE_SIZE = 10000
+"""Maximum number of action bitsets kept in memory by each process."""
+
+ACCESS_MERGED_PERMISSION_CACHE = False
+"""Cache the merged expansion of permissions with several actions.
+
+The merged needs and excludes of the actions of a permission are stored in
+``ACCESS_CACHE`` under a digest of its actions, with a digest of the
+generations of the actions. The entry and the generations are fetched with
+a single ``get_many``, so that checking the permission takes one round trip
+and no union of large expansions. An entry is stored again when one of its
+actions changes.
+"""
+
+ACCESS_ARGUMENT_UNION_ALL_DIALECTS = ["sqlite"]
+"""Database dialects on which action arguments are queried with ``UNION ALL``.
+
+The grants of an action argument and the grants without argument are then
+selected by two queries which each use the ``(action, argument)`` index,
+instead of an ``OR`` which only uses it for the action. Other dialects, e.g.
+``"postgresql"`` whose planner can combine both conditions with a bitmap
+scan, can be added once the gain is measured on their database.
+"""
+
+ACCESS_READ_ENGINE = None
+"""Database used to read grants, e.g. a read-only replica.
+
+A SQLAlchemy database URL or engine. If set, the queries expanding actions
+run on it instead of the primary database.
+"""
+
+ACCESS_READ_ENGINE_STALENESS = 5
+"""Seconds during which grants are read from the primary database after a
+grant change committed in the same session, so that the change is seen
+before it reaches the read engine.
+"""
+
+ACCESS_REPLICA = False
+"""Expand actions from an in-process replica of the grant tables.
+
+All the grants are loaded in the memory of each process before the first
+request, and actions are then expanded without any cache lookup or database
+query. The replica is kept up to date by polling the grant changelog. It
+only holds committed grants, so the sessions which changed grants expand
+actions as usual during ``ACCESS_READ_ENGINE_STALENESS`` seconds.
+"""
+
+ACCESS_REPLICA_POLL_INTERVAL = 1
+"""Seconds between two polls of the grant changelog by the replica."""
+
+ACCESS_REPLICA_POLL_OVERLAP = 1000
+"""Number of sequence numbers of the grant changelog polled again by the
+replica and by the readers of the grant snapshot, so that the changes
+committed after changes with a higher sequence are applied.
+"""
+
+ACCESS_REPLICA_RELOAD_INTERVAL = 3600
+"""Seconds after which the replica loads all the grants again, or ``None``.
+
+It applies the changes committed too late to be polled, and the grant
+changes which were not logged, e.g. made with raw SQL.
+"""
+
+ACCESS_SNAPSHOT_PATH = None
+"""Path of a snapshot of the grants to expand actions from.
+
+The snapshot is built with ``invenio access snapshot build`` and mapped in
+memory by each process, so the processes of a host share one copy. Actions
+changed since the snapshot was built are expanded as usual until the
+snapshot is built again.
+"""
+
+ACCESS_SNAPSHOT_CHECK_INTERVAL = 10
+"""Seconds between two checks of the snapshot file and of the grant
+changelog for actions changed since the snapshot was built.
+"""
+
 ACCESS_LOAD_SYSTEM_ROLE_NEEDS = True
 """Enables the loading of system role needs when users' identity change."""
@@ -0,0 +1,300 @@
+# SPDX-FileCopyrightText: 2026 CERN.
+# SPDX-License-Identifier: MIT
+
+"""Compact representation of expanded actions.
+
+An action expands to the needs of all the users, roles and system roles it
+is granted to. Holding each user grant as a ``UserNeed`` namedtuple in a
+Python ``set`` costs well over 100 bytes per grant, so the expansions are
+held in a :class:`NeedSet` instead, which stores the user ids in a sorted
+integer array and only creates ``UserNeed`` instances when it is iterated.
+
+The other needs of the expansions are interned: each distinct role or
+system role need is represented by a single instance shared by all the
+expansions, see :func:`intern_need`.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from collections.abc import Set
+from heapq import merge as merge_sorted
+from itertools import chain
+
+from flask_principal import Need
+
+_interned_needs = {}
+"""Interned needs, other than the user needs with an integer id."""
+
+
+def intern_need(need):
+    """Return the interned instance of a need.
+
+    The same few thousand roles and system roles recur across all the
+    expansions, so sharing one instance per need saves memory and lets set
+    lookups compare needs by identity. The table is never purged, it grows
+    with the number of distinct needs granted to actions.
+
+    User needs with an integer id are returned as is: need sets only keep
+    their ids, and there may be too many users to keep one need per user.
+
+    :param need: A need.
+    :returns: An instance equal to ``need``.
+    """
+    if _is_user_id(need):
+        return need
+    return _interned_needs.setdefault(need, need)
+
+
+def _is_user_id(need):
+    """Check if a need is a user need with an integer id."""
+    return (
+        isinstance(need, tuple)
+        and len(need) == 2
+        and need[0] == "id"
+        and type(need[1]) is int
+    )
+
+
+class NeedSet(Set):
+    """Immutable set of needs with a compact storage of user needs.
+
+    User needs with an integer id are stored in a sorted ``array("q")`` and
+    tested by bisection, all the other needs (roles, system roles...) in a
+    small frozenset. The class implements the set interface used by
+    :class:`flask_principal.Permission`, so it can be returned by
+    :attr:`invenio_access.permissions.Permission.needs`: comparisons with
+    sets, iteration, ``intersection``, ``union``, ``difference``...
+    """
+
+    __slots__ = ("_users", "_needs")
+
+    def __init__(self, needs=()):
+        """Initialize the set.
+
+        :param needs: An iterable of needs, where integers are taken as
+            user ids. (Default: ``()``)
+        """
+        users, others = set(), set()
+        for need in needs:
+            if type(need) is int:
+                users.add(need)
+            elif _is_user_id(need):
+                users.add(need[1])
+            else:
+                others.add(intern_need(need))
+        self._users = array("q", sorted(users))
+        self._needs = frozenset(others)
+
+    @classmethod
+    def from_parts(cls, users, needs=frozenset()):
+        """Create a set from its parts, without copying them.
+
+        :param users: A sorted sequence of unique integer user ids, e.g. an
+            ``array("q")``.
+        :param needs: A frozenset of the other needs.
+            (Default: ``frozenset()``)
+        """
+        self = cls.__new__(cls)
+        self._users = users
+        self._needs = needs
+        return self
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        """Create a set from the result of a set operation."""
+        return cls(iterable)
+
+    @property
+    def user_ids(self):
+        """The sorted integer user ids."""
+        return self._users
+
+    @property
+    def other_needs(self):
+        """The needs which are not user needs with an integer id."""
+        return self._needs
+
+    def __contains__(self, need):
+        """Test if a need is in the set."""
+        if _is_user_id(need):
+            users = self._users
+            index = bisect_left(users, need[1])
+            return index != len(users) and users[index] == need[1]
+        return need in self._needs
+
+    def __iter__(self):
+        """Iterate over the needs, creating the user needs lazily."""
+        for user_id in self._users:
+            yield Need("id", user_id)
+        yield from self._needs
+
+    def __len__(self):
+        """Return the number of needs."""
+        return len(self._users) + len(self._needs)
+
+    def __eq__(self, other):
+        """Compare with another set."""
+        if isinstance(other, NeedSet):
+            return self._needs == other._needs and self._users == other._users
+        return super(NeedSet, self).__eq__(other)
+
+    __hash__ = Set._hash
+
+    def __repr__(self):
+        """Return the representation of the set."""
+        return f"{self.__class__.__name__}({set(self)!r})"
+
+    def __reduce__(self):
+        """Pickle the parts of the set."""
+        users = self._users
+        if not isinstance(users, array):
+            # e.g. a view on a memory-mapped snapshot
+            users = array("q", users)
+        return (self.from_parts, (users, self._needs))
+
+    def isdisjoint(self, other):
+        """Test if the set has no need in common with ``other``."""
+        if isinstance(other, NeedSet) and len(other) > len(self):
+            return other.isdisjoint(self)
+        return not any(need in self for need in other)
+
+    def intersection(self, *others):
+        """Return the needs of the set which are in all the ``others``.
+
+        The other iterables, typically the small ``provides`` set of an
+        identity, are iterated instead of the set.
+        """
+        if not others:
+            return set(self)
+        first, rest = others[0], others[1:]
+        result = {need for need in first if need in self}
+        for other in rest:
+            result.intersection_update(other)
+        return result
+
+    def union(self, *others):
+        """Return the needs which are in the set or in any of the ``others``."""
+        return self.merge((self,) + others)
+
+    def difference(self, *others):
+        """Return the needs of the set which are in none of the ``others``."""
+        others = [o if isinstance(o, Set) else set(o) for o in others]
+        return NeedSet(n for n in self if not any(n in o for o in others))
+
+    def issubset(self, other):
+        """Test if all the needs of the set are in ``other``."""
+        return all(need in other for need in self)
+
+    def issuperset(self, other):
+        """Test if all the needs of ``other`` are in the set."""
+        return all(need in self for need in other)
+
+    @classmethod
+    def merge(cls, sets):
+        """Return the union of several sets of needs.
+
+        The user ids of :class:`NeedSet` instances are merged without
+        creating any ``UserNeed``.
+
+        :param sets: An iterable of :class:`NeedSet` or any iterables of needs.
+        """
+        user_arrays, others = [], []
+        for needs in sets:
+            if not isinstance(needs, NeedSet):
+                needs = cls(needs)
+            if needs._users:
+                user_arrays.append(needs._users)
+            if needs._needs:
+                others.append(needs._needs)
+        if len(user_arrays) == 1:
+            users = user_arrays[0]
+        else:
+            users = array("q")
+            last = None
+            for user_id in merge_sorted(*user_arrays):
+                if user_id != last:
+                    users.append(user_id)
+                    last = user_id
+        if len(others) == 1:
+            needs = others[0]
+        else:
+            needs = frozenset(chain.from_iterable(others))
+        return cls.from_parts(users, needs)
+
+
+_EMPTY = NeedSet()
+
+OPEN_NEEDS = frozenset(
+    [Need("system_role", "any_user"), Need("system_role", "authenticated_user")]
+)
+"""Needs of the ``any_user`` and ``authenticated_user`` system roles."""
+
+
+class ActionExpansion(namedtuple("ActionExpansion", ["needs", "excludes"])):
+    """Needs and excludes of an expanded action or permission.
+
+    Expansions are immutable: they are tuples of two :class:`NeedSet`, and
+    have no instance dictionary. They can therefore be shared between
+    threads, permissions and the action cache without being copied. They
+    compare equal to any ``(needs, excludes)`` pair of sets.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, needs=(), excludes=()):
+        """Create an expansion, converting the needs to need sets."""
+        if not isinstance(needs, NeedSet):
+            needs = NeedSet(needs)
+        if not isinstance(excludes, NeedSet):
+            excludes = NeedSet(excludes)
+        return super(ActionExpansion, cls).__new__(cls, needs, excludes)
+
+    @property
+    def has_excludes(self):
+        """Whether the action excludes any need."""
+        return len(self.excludes) != 0
+
+    @property
+    def is_open(self):
+        """Whether the action is granted to all users and excludes nobody.
+
+        An action is open if it is granted to the ``any_user`` or the
+        ``authenticated_user`` system role and has no excludes. It is
+        computed from the need sets in constant time.
+        """
+        return not self.has_excludes and not OPEN_NEEDS.isdisjoint(
+            self.needs.other_needs
+        )
+
+    @property
+    def open_needs(self):
+        """The open system roles the action is granted to.
+
+        See :data:`~invenio_access.expansions.OPEN_NEEDS`.
+        """
+        return OPEN_NEEDS.intersection(self.needs.other_needs)
+
+    @classmethod
+    def from_grants(cls, grants):
+        """Create the expansion of ``(exclude, need)`` grants.
+
+        The need of a user grant may be given as the integer user id.
+        """
+        needs, excludes = [], []
+        for exclude, need in grants:
+            (excludes if exclude else needs).append(need)
+        return cls(needs=needs, excludes=excludes)
+
+    @classmethod
+    def merge(cls, expansions):
+        """Merge the needs and excludes of several expansions.
+
+        The excludes are only merged if at least one expansion has some.
+        """
+        expansions = list(expansions)
+        excludes = [e.excludes for e in expansions if e.has_excludes]
+        return cls(
+            needs=NeedSet.merge(e.needs for e in expansions),
+            excludes=NeedSet.merge(excludes) if excludes else _EMPTY,
+        )
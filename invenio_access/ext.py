@@ -4,13 +4,35 @@
 
 """Invenio module for common role based access control."""
 
+import hashlib
+import os
+import threading
+import time
+from collections import Counter
+
 import six
+import sqlalchemy as sa
 from flask_principal import identity_loaded
 from invenio_base.utils import entry_points
 from werkzeug.utils import cached_property, import_string
 
 from . import config
+from .bitsets import BitsetEngine
 from .loaders import load_permissions_on_identity_loaded
+from .models import AccessChangelog, get_action_cache_key, get_action_cache_keys
+from .permissions import load_action_expansions
+from .replica import GrantReplica
+from .snapshot import SnapshotReader
+
+
+def _new_generation():
+    """Return a new action generation token."""
+    return os.urandom(8).hex()
+
+
+def _generations_digest(generations):
+    """Return a digest of the generations of several actions."""
+    return hashlib.sha1("\0".join(generations).encode("utf-8")).hexdigest()
 
 
 class _AccessState(object):
@@ -32,6 +54,10 @@ class _AccessState(object):
         self.actions = {}
         self.system_roles = {}
         self._cache = cache
+        self.stats = Counter()
+        """Action cache counters of this process (hits, misses, sets...)."""
+        self.warmup_duration = None
+        """Duration in seconds of the last action cache warm-up."""
         if entry_point_actions:
             self.load_entry_point_actions(entry_point_actions)
         if entry_point_system_roles:
@@ -43,6 +69,106 @@ class _AccessState(object):
         cache = self._cache or self.app.config.get("ACCESS_CACHE")
         return import_string(cache) if isinstance(cache, six.string_types) else cache
 
+    @cached_property
+    def read_engine(self):
+        """Return the engine used to read grants, if one is configured."""
+        engine = self.app.config.get("ACCESS_READ_ENGINE")
+        if isinstance(engine, six.string_types):
+            engine = sa.create_engine(engine)
+        return engine
+
+    @cached_property
+    def serializer(self):
+        """Return the action cache serializer."""
+        serializer = self.app.config.get("ACCESS_ACTION_CACHE_SERIALIZER")
+        if isinstance(serializer, six.string_types):
+            serializer = import_string(serializer)
+        if isinstance(serializer, type):
+            serializer = serializer.from_config(self.app.config)
+        return serializer
+
+    @cached_property
+    def bitset_engine(self):
+        """Return the bitset engine, if the bitset evaluation is enabled.
+
+        The bitset evaluation requires a cache system, since the bitsets are
+        validated against the action generations stored in the cache.
+        """
+        if self.app.config.get("ACCESS_BITSET_EVALUATION") and self.cache:
+            return BitsetEngine(
+                max_size=self.app.config.get("ACCESS_BITSET_CACHE_SIZE", 10000)
+            )
+        return None
+
+    @cached_property
+    def replica(self):
+        """Return the in-process grant replica, if it is enabled."""
+        if self.app.config.get("ACCESS_REPLICA"):
+            return GrantReplica(
+                interval=self.app.config.get("ACCESS_REPLICA_POLL_INTERVAL", 1),
+                overlap=self.app.config.get("ACCESS_REPLICA_POLL_OVERLAP", 1000),
+                reload_interval=self.app.config.get(
+                    "ACCESS_REPLICA_RELOAD_INTERVAL", 3600
+                ),
+            )
+        return None
+
+    @cached_property
+    def snapshot(self):
+        """Return the reader of the grant snapshot, if one is configured."""
+        path = self.app.config.get("ACCESS_SNAPSHOT_PATH")
+        if path:
+            return SnapshotReader(
+                path,
+                interval=self.app.config.get("ACCESS_SNAPSHOT_CHECK_INTERVAL", 10),
+                overlap=self.app.config.get("ACCESS_REPLICA_POLL_OVERLAP", 1000),
+            )
+        return None
+
+    def _action_cache_key(self, action_key):
+        """Return the key under which an action is stored in the cache."""
+        return self.app.config["ACCESS_ACTION_CACHE_PREFIX"] + action_key
+
+    def _stats_cache_key(self, name):
+        """Return the key under which a shared counter is stored."""
+        return self._action_cache_key("__stats__::" + name)
+
+    def _generation_cache_key(self, action_key):
+        """Return the key under which the generation of an action is stored."""
+        return self._action_cache_key("__generation__::" + action_key)
+
+    def _changelog_cache_key(self):
+        """Return the key under which the last applied change is stored."""
+        return self._action_cache_key("__changelog__")
+
+    def _count(self, name, delta=1):
+        """Increment an action cache counter.
+
+        The counter is always kept for the current process. If
+        ``ACCESS_ACTION_CACHE_STATS`` is enabled, it is also incremented in
+        the cache so that the statistics of all processes can be reported.
+        """
+        self.stats[name] += delta
+        if self.app.config.get("ACCESS_ACTION_CACHE_STATS") and self.cache:
+            self.cache.inc(self._stats_cache_key(name), delta)
+
+    def get_action_cache_stats(self):
+        """Get the action cache counters.
+
+        :returns: The counters shared by all processes if
+            ``ACCESS_ACTION_CACHE_STATS`` is enabled, otherwise the counters of
+            the current process. The counters of the serializer, e.g. about
+            decompression, are always the ones of the current process.
+        """
+        stats = dict(getattr(self.serializer, "stats", {}))
+        if not (self.app.config.get("ACCESS_ACTION_CACHE_STATS") and self.cache):
+            stats.update(self.stats)
+            return stats
+        names = ("hits", "misses", "sets", "deletes")
+        values = self.cache.get_many(*(self._stats_cache_key(n) for n in names))
+        stats.update((name, value or 0) for name, value in zip(names, values))
+        return stats
+
     def set_action_cache(self, action_key, data):
         """Store action needs and excludes.
 
@@ -53,8 +179,26 @@ class _AccessState(object):
         """
         if self.cache:
             self.cache.set(
-                self.app.config["ACCESS_ACTION_CACHE_PREFIX"] + action_key, data
+                self._action_cache_key(action_key), self.serializer.dumps(data)
+            )
+            self._count("sets")
+
+    def set_many_action_cache(self, mapping):
+        """Store the needs and excludes of several actions at once.
+
+        .. note:: The actions are saved only if a cache system is defined.
+
+        :param mapping: A dictionary mapping action keys to the actions to be
+            saved.
+        """
+        if self.cache and mapping:
+            self.cache.set_many(
+                {
+                    self._action_cache_key(k): self.serializer.dumps(v)
+                    for k, v in mapping.items()
+                }
             )
+            self._count("sets", len(mapping))
 
     def get_action_cache(self, action_key):
         """Get action needs and excludes from cache.
@@ -66,11 +210,38 @@ class _AccessState(object):
         """
         data = None
         if self.cache:
-            data = self.cache.get(
-                self.app.config["ACCESS_ACTION_CACHE_PREFIX"] + action_key
-            )
+            data = self.cache.get(self._action_cache_key(action_key))
+            if data is not None:
+                data = self.serializer.loads(data)
+            self._count("misses" if data is None else "hits")
         return data
 
+    def get_many_action_cache(self, action_keys, count=True, raw=False):
+        """Get the needs and excludes of several actions at once.
+
+        :param action_keys: The unique action names.
+        :param count: If ``False``, the lookups are not counted as hits or
+            misses. (Default: ``True``)
+        :param raw: If ``True``, the values are returned as stored, without
+            being deserialized. (Default: ``False``)
+        :returns: A list with the action stored in cache or ``None`` for each
+            action key.
+        """
+        action_keys = list(action_keys)
+        if not (self.cache and action_keys):
+            return [None] * len(action_keys)
+        values = self.cache.get_many(*map(self._action_cache_key, action_keys))
+        if not raw:
+            values = [
+                None if value is None else self.serializer.loads(value)
+                for value in values
+            ]
+        if count:
+            hits = sum(1 for value in values if value is not None)
+            self._count("hits", hits)
+            self._count("misses", len(values) - hits)
+        return values
+
     def delete_action_cache(self, action_key):
         """Delete action needs and excludes from cache.
 
@@ -79,9 +250,154 @@ class _AccessState(object):
         :param action_key: The unique action name.
         """
         if self.cache:
-            self.cache.delete(
-                self.app.config["ACCESS_ACTION_CACHE_PREFIX"] + action_key
+            self.cache.delete(self._action_cache_key(action_key))
+            self.cache.set(self._generation_cache_key(action_key), _new_generation())
+            self._count("deletes")
+
+    def get_action_generations(self, action_keys):
+        """Get the generations of several actions.
+
+        The generation of an action is an opaque token renewed each time the
+        action is invalidated. It lets each process keep derived data about
+        an action, e.g. its bitsets, as long as the generation is unchanged.
+
+        :param action_keys: The unique action names.
+        :returns: A list with the generation of each action, or ``None`` for
+            each action if no cache system is defined.
+        """
+        action_keys = list(action_keys)
+        if not (self.cache and action_keys):
+            return [None] * len(action_keys)
+        keys = [self._generation_cache_key(k) for k in action_keys]
+        return self._fill_generations(keys, self.cache.get_many(*keys))
+
+    def _fill_generations(self, keys, generations):
+        """Create the generations missing from the cache."""
+        generations = list(generations)
+        for i, generation in enumerate(generations):
+            if generation is None:
+                generation = _new_generation()
+                if not self.cache.add(keys[i], generation):
+                    generation = self.cache.get(keys[i])
+                generations[i] = generation
+        return generations
+
+    def _merged_cache_key(self, action_keys):
+        """Return the key under which the merged actions are stored."""
+        digest = hashlib.sha1("\0".join(action_keys).encode("utf-8")).hexdigest()
+        return self._action_cache_key("__merged__::" + digest)
+
+    def get_merged_action_cache(self, action_keys):
+        """Get the merged expansion of several actions from cache.
+
+        The entry and the generations of the actions are fetched with a single
+        ``get_many``. The entry holds a digest of the generations of the
+        actions it was merged from, and is only returned if they are unchanged.
+
+        :param action_keys: The sorted unique action names.
+        :returns: A tuple ``(expansion, generations)``, with the merged
+            expansion or ``None``, and the current generations of the actions
+            to store a new merged expansion with.
+        """
+        action_keys = list(action_keys)
+        if not (self.cache and action_keys):
+            return None, [None] * len(action_keys)
+        keys = [self._generation_cache_key(k) for k in action_keys]
+        entry, *generations = self.cache.get_many(
+            self._merged_cache_key(action_keys), *keys
+        )
+        generations = self._fill_generations(keys, generations)
+        data = None
+        if entry is not None and entry[0] == _generations_digest(generations):
+            data = self.serializer.loads(entry[1])
+        self._count("misses" if data is None else "hits")
+        return data, generations
+
+    def set_merged_action_cache(self, action_keys, generations, data):
+        """Store the merged expansion of several actions.
+
+        .. note:: The expansion is saved only if a cache system is defined.
+
+        :param action_keys: The sorted unique action names.
+        :param generations: The generations of the actions, as returned by
+            :meth:`get_merged_action_cache` before they were expanded.
+        :param data: The merged expansion of the actions.
+        """
+        if self.cache:
+            self.cache.set(
+                self._merged_cache_key(action_keys),
+                (_generations_digest(generations), self.serializer.dumps(data)),
             )
+            self._count("sets")
+
+    def apply_changelog(self, batch_size=1000):
+        """Invalidate the cache entries of the grants changed since the last call.
+
+        The changes are read from the grant changelog, from the sequence of
+        the last applied change, which is shared in the cache. A change of an
+        action without argument also invalidates the entries of all the
+        arguments of the action, since their expansions include it. The
+        first call only records the current end of the changelog.
+
+        .. note:: The sequence of a transaction is assigned before it
+            commits, so a change committed after a later one may be skipped.
+            Its entries are still invalidated by the process which wrote it.
+
+        :param batch_size: Number of changes read per query.
+            (Default: ``1000``)
+        :returns: The number of applied changes.
+        """
+        if not self.cache:
+            return 0
+        key = self._changelog_cache_key()
+        last = self.cache.get(key)
+        if last is None:
+            self.cache.set(key, AccessChangelog.last_sequence(), timeout=0)
+            return 0
+        count = 0
+        while True:
+            changes = AccessChangelog.changes_since(last, limit=batch_size)
+            if not changes:
+                break
+            actions, keys = set(), set()
+            for _, action, argument in changes:
+                if argument is None:
+                    actions.add(action)
+                else:
+                    keys.add(get_action_cache_key(action, argument))
+            keys.update(get_action_cache_keys(actions) if actions else ())
+            for action_key in keys:
+                self.delete_action_cache(action_key)
+            last = changes[-1][0]
+            count += len(changes)
+            self.cache.set(key, last, timeout=0)
+        return count
+
+    def warm_up(self, actions=None):
+        """Preload the expansions of actions into the cache.
+
+        All actions are expanded with one query per grant table and stored
+        with a single ``set_many``.
+
+        :param actions: The action names. If ``None``, the actions are taken
+            from ``ACCESS_WARMUP_ACTIONS``, where ``"*"`` means all the
+            registered actions. (Default: ``None``)
+        :returns: The number of cached entries.
+        """
+        if actions is None:
+            actions = self.app.config.get("ACCESS_WARMUP_ACTIONS") or []
+        if actions == "*":
+            actions = self.actions.keys()
+        start = time.monotonic()
+        expansions = load_action_expansions(actions)
+        self.set_many_action_cache(expansions)
+        self.warmup_duration = time.monotonic() - start
+        self.app.logger.info(
+            "Warmed up %d action cache entries in %.3fs.",
+            len(expansions),
+            self.warmup_duration,
+        )
+        return len(expansions)
 
     def register_action(self, action):
         """Register an action to be showed in the actions list.
@@ -171,8 +487,53 @@ class InvenioAccess(object):
         if app.config.get("ACCESS_LOAD_SYSTEM_ROLE_NEEDS", True):
             identity_loaded.connect_via(app)(load_permissions_on_identity_loaded)
 
+        if app.config.get("ACCESS_WARMUP_ACTIONS"):
+            self.init_warm_up(app, state)
+
+        if app.config.get("ACCESS_REPLICA"):
+            self.init_replica(app, state)
+
         return state
 
+    def init_warm_up(self, app, state):
+        """Warm up the action cache before the first request is handled.
+
+        :param app: The Flask application.
+        :param state: The access state.
+        """
+        warmed_up = threading.Event()
+        lock = threading.Lock()
+
+        def warm_up():
+            if warmed_up.is_set():
+                return
+            with lock:
+                # concurrent first requests wait for a single warm-up
+                if warmed_up.is_set():
+                    return
+                try:
+                    state.warm_up()
+                except Exception:
+                    app.logger.exception("Action cache warm-up failed.")
+                finally:
+                    warmed_up.set()
+
+        app.before_request(warm_up)
+
+    def init_replica(self, app, state):
+        """Load the grant replica before the first request is handled.
+
+        :param app: The Flask application.
+        :param state: The access state.
+        """
+
+        def load_replica():
+            if state.replica.sequence is None:
+                # concurrent first requests wait for a single load
+                state.replica.refresh()
+
+        app.before_request(load_replica)
+
     def init_config(self, app):
         """Initialize configuration.
 
@@ -5,14 +5,19 @@
 
 """Database models for access module."""
 
+import time
+
+import sqlalchemy as sa
+from flask import current_app
 from flask_principal import RoleNeed, UserNeed
 from invenio_accounts.models import Role, User
 from invenio_db import db
 from sqlalchemy import UniqueConstraint
 from sqlalchemy.event import listen
-from sqlalchemy.orm import validates
+from sqlalchemy.orm import Session, object_session, validates
 from sqlalchemy.orm.attributes import get_history
 
+from .expansions import intern_need
 from .proxies import current_access
 
 
@@ -68,17 +73,26 @@ class ActionNeedMixin(object):
         return cls.create(action, exclude=True, **kwargs)
 
     @classmethod
-    def query_by_action(cls, action, argument=None):
+    def query_by_action(cls, action, argument=None, union_all=False):
         """Prepare query object with filtered action.
 
         :param action: The action to deny.
         :param argument: The action argument. If it's ``None`` then, if exists,
             the ``action.argument`` will be taken. In the worst case will be
             set as ``None``. (Default: ``None``)
+        :param union_all: If ``True``, the grants of the argument and the
+            grants without argument are selected by a ``UNION ALL`` of two
+            queries instead of an ``OR``, so that each of them can use the
+            ``(action, argument)`` index. Such queries can't be used for bulk
+            updates or deletes. (Default: ``False``)
         :returns: A query object.
         """
         query = db.session.query(cls).filter_by(action=action.value)
         argument = argument or getattr(action, "argument", None)
+        if argument is not None and union_all:
+            return query.filter(cls.argument == str(argument)).union_all(
+                query.filter(cls.argument.is_(None))
+            )
         if argument is not None:
             query = query.filter(
                 db.or_(
@@ -115,6 +129,14 @@ class ActionUsers(ActionNeedMixin, db.Model):
             "user_id",
             name="access_actionsusers_unique",
         ),
+        db.Index(
+            "ix_access_actionsusers_action_argument",
+            "action",
+            "argument",
+            "exclude",
+            "user_id",
+            postgresql_include=["id"],
+        ),
     )
 
     user_id = db.Column(
@@ -150,6 +172,14 @@ class ActionRoles(ActionNeedMixin, db.Model):
             "role_id",
             name="access_actionsroles_unique",
         ),
+        db.Index(
+            "ix_access_actionsroles_action_argument",
+            "action",
+            "argument",
+            "exclude",
+            "role_id",
+            postgresql_include=["id"],
+        ),
     )
 
     role_id = db.Column(
@@ -166,7 +196,7 @@ class ActionRoles(ActionNeedMixin, db.Model):
     @property
     def need(self):
         """Return RoleNeed instance."""
-        return RoleNeed(self.role.id)
+        return intern_need(RoleNeed(self.role.id))
 
 
 class ActionSystemRoles(ActionNeedMixin, db.Model):
@@ -186,6 +216,14 @@ class ActionSystemRoles(ActionNeedMixin, db.Model):
             "role_name",
             name="access_actionssystemroles_unique",
         ),
+        db.Index(
+            "ix_access_actionssystemroles_action_argument",
+            "action",
+            "argument",
+            "exclude",
+            "role_name",
+            postgresql_include=["id"],
+        ),
     )
 
     role_name = db.Column(db.String(40), nullable=False, index=True)
@@ -208,7 +246,120 @@ class ActionSystemRoles(ActionNeedMixin, db.Model):
     @property
     def need(self):
         """Return the corresponding Need instance."""
-        return current_access.system_roles[self.role_name]
+        return intern_need(current_access.system_roles[self.role_name])
+
+
+class AccessChangelog(db.Model):
+    """Append-only log of the grant changes.
+
+    Each change of a grant appends the ``(action, argument)`` pair whose
+    expansion it changes. The primary key is a monotonically increasing
+    sequence, so that caches and replicas can apply the changes logged since
+    the last sequence they have seen.
+
+    The changelog is not pruned automatically, the old changes are deleted
+    with :meth:`prune` or ``invenio access changelog prune``.
+    """
+
+    __tablename__ = "access_changelog"
+
+    id = db.Column(
+        db.BigInteger().with_variant(db.Integer, "sqlite"),
+        autoincrement=True,
+        primary_key=True,
+    )
+    """Sequence number of the change."""
+
+    action = db.Column(db.String(80), nullable=False)
+    """Name of the changed action."""
+
+    argument = db.Column(db.String(255), nullable=True)
+    """Argument of the changed action, ``None`` for all its arguments."""
+
+    created = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+    """Time of the change."""
+
+    @classmethod
+    def last_sequence(cls, connection=None):
+        """Get the sequence number of the last logged change, or ``0``.
+
+        :param connection: The connection to read from. If ``None``, the
+            changelog is read with :func:`execute_read`. (Default: ``None``)
+        """
+        statement = sa.select(sa.func.max(cls.id))
+        return _execute_read_on(connection, statement)[0][0] or 0
+
+    @classmethod
+    def changes_since(cls, sequence, limit=None, connection=None):
+        """Get the changes logged after a sequence number.
+
+        :param sequence: The last sequence number already seen.
+        :param limit: The maximum number of changes. (Default: ``None``)
+        :param connection: The connection to read from. If ``None``, the
+            changelog is read with :func:`execute_read`. (Default: ``None``)
+        :returns: A list of ``(sequence, action, argument)`` rows ordered by
+            sequence.
+        """
+        statement = (
+            sa.select(cls.id, cls.action, cls.argument)
+            .where(cls.id > sequence)
+            .order_by(cls.id)
+            .limit(limit)
+        )
+        return _execute_read_on(connection, statement)
+
+    @classmethod
+    def prune(cls, keep=None, before=None):
+        """Delete the old changes from the changelog.
+
+        The changes matching all the given conditions are deleted in the
+        current session. The last change is always kept, so that the
+        sequence never goes back, e.g. on SQLite which reuses the highest
+        deleted primary key.
+
+        The changes which are still to be applied must be kept: those logged
+        since the oldest grant snapshot in use was built, since the last
+        ``invenio access cache sync``, and the last
+        ``ACCESS_REPLICA_POLL_OVERLAP`` sequence numbers polled again by the
+        replicas.
+
+        :param keep: Number of sequence numbers to keep before the last
+            change, or ``None``. (Default: ``None``)
+        :param before: Only delete the changes logged before this naive UTC
+            datetime, or ``None``. (Default: ``None``)
+        :returns: The number of deleted changes.
+        """
+        last = cls.last_sequence(connection=db.session)
+        statement = sa.delete(cls).where(cls.id < last)
+        if keep is not None:
+            statement = statement.where(cls.id <= last - keep)
+        if before is not None:
+            statement = statement.where(cls.created < before)
+        return db.session.execute(statement).rowcount
+
+
+def log_grant_changes(connection, keys):
+    """Append grant changes to the changelog.
+
+    :param connection: The connection or session on which the changes are
+        written, so that they are logged in the same transaction.
+    :param keys: The changed ``(action, argument)`` pairs.
+    """
+    rows = [
+        {"action": action, "argument": None if argument is None else str(argument)}
+        for action, argument in sorted(set(keys), key=lambda k: tuple(map(str, k)))
+    ]
+    if rows:
+        connection.execute(AccessChangelog.__table__.insert(), rows)
+
+
+def use_argument_union_all():
+    """Check if action arguments are queried with ``UNION ALL`` on this database.
+
+    The dialects are configured with ``ACCESS_ARGUMENT_UNION_ALL_DIALECTS``.
+    """
+    dialects = current_app.config.get("ACCESS_ARGUMENT_UNION_ALL_DIALECTS", ())
+    return db.session.get_bind().dialect.name in dialects
 
 
 def get_action_cache_key(name, argument):
@@ -219,8 +370,116 @@ def get_action_cache_key(name, argument):
     return "::".join(tokens)
 
 
+def get_action_cache_keys(actions):
+    """Get the cache keys of the given actions and of their arguments.
+
+    The arguments are the distinct arguments having a grant in any of the
+    grant tables.
+
+    :param actions: The action names.
+    :returns: A sorted list of action cache keys.
+    """
+    actions = set(actions)
+    keys = {get_action_cache_key(action, None) for action in actions}
+    for model in (ActionUsers, ActionRoles, ActionSystemRoles):
+        query = (
+            db.session.query(model.action, model.argument)
+            .filter(model.action.in_(actions), model.argument.isnot(None))
+            .distinct()
+        )
+        keys.update(
+            get_action_cache_key(a, arg) for a, arg in execute_read(query.statement)
+        )
+    return sorted(keys)
+
+
+_GRANTS_WRITTEN = "invenio_access_grants_written"
+"""Session info key of the last grant change of a session.
+
+It holds ``None`` while the change is not committed, then the time of the
+commit.
+"""
+
+
+def mark_grants_written(session):
+    """Record that grants were changed in a session.
+
+    Until ``ACCESS_READ_ENGINE_STALENESS`` seconds after the change is
+    committed, the grants read in this session are read from the primary
+    database instead of the read engine.
+
+    :param session: The database session.
+    """
+    session.info[_GRANTS_WRITTEN] = None
+
+
+def _commit_grants_written(session):
+    """Record the time at which grant changes are committed."""
+    if _GRANTS_WRITTEN in session.info and session.info[_GRANTS_WRITTEN] is None:
+        session.info[_GRANTS_WRITTEN] = time.monotonic()
+
+
+def _rollback_grants_written(session):
+    """Forget grant changes which were rolled back."""
+    if session.info.get(_GRANTS_WRITTEN, 0) is None:
+        del session.info[_GRANTS_WRITTEN]
+
+
+def grants_recently_written(session):
+    """Check if grants were changed in a session in the staleness window.
+
+    :param session: The database session.
+    """
+    if _GRANTS_WRITTEN not in session.info:
+        return False
+    written = session.info[_GRANTS_WRITTEN]
+    staleness = current_app.config.get("ACCESS_READ_ENGINE_STALENESS", 5)
+    return written is None or time.monotonic() - written < staleness
+
+
+def execute_read(statement, params=None):
+    """Execute a query reading grants.
+
+    If ``ACCESS_READ_ENGINE`` is configured, the query runs on the read
+    engine, unless grants were changed in the current session shortly
+    before, see :func:`mark_grants_written`.
+
+    :param statement: The statement to execute.
+    :param params: The parameters of the statement. (Default: ``None``)
+    :returns: The list of result rows.
+    """
+    engine = current_access.read_engine
+    if engine is None or grants_recently_written(db.session):
+        return db.session.execute(statement, params).all()
+    with engine.connect() as connection:
+        return connection.execute(statement, params).all()
+
+
+def connect_read():
+    """Open a connection reading committed grants.
+
+    The connection is opened on ``ACCESS_READ_ENGINE`` if it is configured,
+    otherwise on the primary database, but never shares the transaction of
+    the current session. It is meant for the data kept by a process for all
+    its sessions, e.g. :class:`invenio_access.replica.GrantReplica`.
+
+    :returns: A SQLAlchemy ``Connection``.
+    """
+    engine = current_access.read_engine
+    return (db.engine if engine is None else engine).connect()
+
+
+def _execute_read_on(connection, statement):
+    """Execute a query reading grants on a connection, if one is given."""
+    if connection is None:
+        return execute_read(statement)
+    return connection.execute(statement).all()
+
+
 def removed_or_inserted_action(mapper, connection, target):
     """Remove the action from cache when an item is inserted or deleted."""
+    mark_grants_written(object_session(target))
+    log_grant_changes(connection, [(target.action, target.argument)])
     current_access.delete_action_cache(
         get_action_cache_key(target.action, target.argument)
     )
@@ -244,19 +503,62 @@ def changed_action(mapper, connection, target):
         or argument_history.has_changes()
         or owner_history.has_changes()
     ):
-        current_access.delete_action_cache(
-            get_action_cache_key(target.action, target.argument)
+        old_key = (
+            action_history.deleted[0] if action_history.deleted else target.action,
+            (
+                argument_history.deleted[0]
+                if argument_history.deleted
+                else target.argument
+            ),
         )
+        mark_grants_written(object_session(target))
+        log_grant_changes(connection, [(target.action, target.argument), old_key])
         current_access.delete_action_cache(
-            get_action_cache_key(
-                action_history.deleted[0] if action_history.deleted else target.action,
-                (
-                    argument_history.deleted[0]
-                    if argument_history.deleted
-                    else target.argument
-                ),
-            )
+            get_action_cache_key(target.action, target.argument)
         )
+        current_access.delete_action_cache(get_action_cache_key(*old_key))
+
+
+_OWNER_GRANTS = ((User, ActionUsers, "user_id"), (Role, ActionRoles, "role_id"))
+"""Owner models, with the grant model and its foreign key to the owner."""
+
+
+def deleted_owners_actions(orm_execute_state):
+    """Remove the actions from cache when users or roles are bulk deleted.
+
+    The grants of the deleted users and roles are then deleted by the
+    database with ``ON DELETE CASCADE``, without any ORM event, so they are
+    selected and logged before the statement runs. Users and roles deleted
+    with the ORM are not concerned, their grants are deleted and logged one
+    by one through the ``actionusers`` relationship.
+
+    .. note:: Only the statements executed with the session are intercepted.
+        The grants of users and roles deleted with raw SQL or on another
+        connection are not logged, their actions must be invalidated
+        explicitly, e.g. with ``invenio access cache flush``.
+    """
+    if not orm_execute_state.is_delete:
+        return
+    statement = orm_execute_state.statement
+    for owner, model, owner_id in _OWNER_GRANTS:
+        if not owner.__table__.compare(statement.table):
+            continue
+        owners = sa.select(owner.id)
+        if statement.whereclause is not None:
+            owners = owners.where(statement.whereclause)
+        session = orm_execute_state.session
+        keys = session.execute(
+            sa.select(model.action, model.argument)
+            .where(getattr(model, owner_id).in_(owners))
+            .distinct()
+        ).all()
+        if keys:
+            mark_grants_written(session)
+            log_grant_changes(session, keys)
+            for action, argument in keys:
+                current_access.delete_action_cache(
+                    get_action_cache_key(action, argument)
+                )
 
 
 listen(ActionUsers, "after_insert", removed_or_inserted_action)
@@ -270,3 +572,8 @@ listen(ActionRoles, "after_update", changed_action)
 listen(ActionSystemRoles, "after_insert", removed_or_inserted_action)
 listen(ActionSystemRoles, "after_delete", removed_or_inserted_action)
 listen(ActionSystemRoles, "after_update", changed_action)
+
+listen(Session, "do_orm_execute", deleted_owners_actions)
+
+listen(Session, "after_commit", _commit_grants_written)
+listen(Session, "after_rollback", _rollback_grants_written)
@@ -4,13 +4,26 @@
 """Permission and action needs for Invenio."""
 
 from collections import namedtuple
-from functools import partial
+from functools import lru_cache, partial
 from itertools import chain
+from operator import itemgetter
+from warnings import warn
 
+import sqlalchemy as sa
 from flask_principal import ActionNeed, Identity, Need
 from flask_principal import Permission as _Permission
-
-from .models import ActionRoles, ActionSystemRoles, ActionUsers, get_action_cache_key
+from flask_principal import RoleNeed
+from invenio_db import db
+
+from .expansions import OPEN_NEEDS, ActionExpansion, NeedSet, intern_need
+from .models import (
+    ActionRoles,
+    ActionSystemRoles,
+    ActionUsers,
+    execute_read,
+    get_action_cache_key,
+    use_argument_union_all,
+)
 from .proxies import current_access
 
 _Need = namedtuple("Need", ["method", "value", "argument"])
@@ -65,13 +78,83 @@ system_identity = Identity(system_user_id)
 system_identity.provides.add(system_process)
 
 
-class _P(namedtuple("Permission", ["needs", "excludes"])):
-    """Helper for simple permission updates."""
+_P = ActionExpansion
+"""Alias of :class:`invenio_access.expansions.ActionExpansion`."""
+
+
+class _CompiledPermission(
+    namedtuple(
+        "CompiledPermission",
+        [
+            "needs_source",
+            "excludes_source",
+            "explicit",
+            "actions",
+            "action_needs",
+        ],
+    )
+):
+    """Precomputed parts of a permission.
+
+    ``needs_source`` and ``excludes_source`` are snapshots of the explicit
+    needs and excludes the permission was compiled from, ``explicit`` the
+    expansion of the needs which are not actions, ``actions`` the
+    ``(action_need, cache_key)`` pairs of the actions to expand and
+    ``action_needs`` the need set used to deny access if nobody is granted
+    any of the actions.
+    """
+
+    __slots__ = ()
+
+    def is_compiled_from(self, explicit_needs, explicit_excludes):
+        """Check if the explicit needs and excludes are unchanged."""
+        return (
+            self.needs_source == explicit_needs
+            and self.excludes_source == explicit_excludes
+        )
+
+
+_GRANT_TABLES = (
+    (ActionUsers, "user_id", int),
+    (ActionRoles, "role_id", lambda role_id: intern_need(RoleNeed(role_id))),
+    (
+        ActionSystemRoles,
+        "role_name",
+        lambda role_name: intern_need(current_access.system_roles[role_name]),
+    ),
+)
+"""Grant models, with the name of their owner column and the owner need.
 
-    def update(self, permission):
-        """In-place update of permissions."""
-        self.needs.update(permission.needs)
-        self.excludes.update(permission.excludes)
+The users are converted to their integer ids, which need sets store as is.
+"""
+
+
+@lru_cache(maxsize=None)
+def _expansion_statement(model, owner, has_argument, union_all):
+    """Build the statement selecting the grants of an action.
+
+    The statements are built once and only differ by their bound ``action``
+    and ``argument`` parameters, so SQLAlchemy compiles each of them once.
+    """
+
+    def select_grants(*criteria):
+        statement = sa.select(model.exclude, getattr(model, owner)).where(
+            model.action == sa.bindparam("action"), *criteria
+        )
+        if model is ActionRoles:
+            statement = statement.join(ActionRoles.role)
+        return statement
+
+    if not has_argument:
+        return select_grants(model.argument.is_(None))
+    if union_all:
+        return sa.union_all(
+            select_grants(model.argument == sa.bindparam("argument")),
+            select_grants(model.argument.is_(None)),
+        )
+    return select_grants(
+        sa.or_(model.argument == sa.bindparam("argument"), model.argument.is_(None))
+    )
 
 
 class Permission(_Permission):
@@ -117,7 +200,7 @@ class Permission(_Permission):
 
         :param \*needs: The needs for this permission.
         """
-        self._permissions = None
+        self._compiled = None
         self.explicit_needs = set(needs)
         self.explicit_needs.add(superuser_access)
         self.explicit_excludes = set()
@@ -141,24 +224,111 @@ class Permission(_Permission):
                 other_needs.add(need)
         return action_needs, other_needs
 
-    def _load_permissions(self):
-        """Load permissions for all needs, expanding actions."""
-        result = _P(needs=set(), excludes=set())
+    def compile(self):
+        """Compile the permission.
+
+        The explicit needs and excludes are split into actions and other
+        needs, and the cache keys of the actions are computed, once. The
+        result is reused by all the checks of the permission, and compiled
+        again only if the explicit needs or excludes are modified.
+
+        :returns: The compiled permission.
+        """
+        compiled = getattr(self, "_compiled", None)
+        if compiled is not None and compiled.is_compiled_from(
+            self.explicit_needs, self.explicit_excludes
+        ):
+            return compiled
 
         # split ActionNeeds and any other Need in separates Sets
         action_needs, explicit_needs = self._split_actionsneeds(self.explicit_needs)
         action_excludes, explicit_excludes = self._split_actionsneeds(
             self.explicit_excludes
         )
+        actions = sorted(
+            (
+                (action, self._cache_key(action))
+                for action in action_needs | action_excludes
+            ),
+            key=itemgetter(1),
+        )
+        compiled = _CompiledPermission(
+            needs_source=frozenset(self.explicit_needs),
+            excludes_source=frozenset(self.explicit_excludes),
+            explicit=ActionExpansion(needs=explicit_needs, excludes=explicit_excludes),
+            actions=tuple(actions),
+            action_needs=NeedSet(action_needs),
+        )
+        self._compiled = compiled
+        return compiled
 
-        # add all explicit needs/excludes to the result permissions
-        result.needs.update(explicit_needs)
-        result.excludes.update(explicit_excludes)
+    def _load_permissions(self):
+        """Load permissions for all needs, expanding actions.
+
+        The expansion is not kept on the permission, so that long-lived
+        permissions don't hold on to large expansions.
 
-        # expand all ActionNeeds to get all needs/excludes and add them to the
-        # result permissions
-        for need in action_needs | action_excludes:
-            result.update(self._expand_action(need))
+        If ``ACCESS_MERGED_PERMISSION_CACHE`` is enabled, the merged expansion
+        of the actions of a permission with several actions is itself cached,
+        with the generations of the actions, so that it is loaded with a
+        single lookup. The explicit needs and excludes are merged afterwards.
+
+        :returns: An :class:`invenio_access.expansions.ActionExpansion`.
+        """
+        compiled = self.compile()
+        state = current_access._get_current_object()
+        if (
+            len(compiled.actions) > 1
+            and state.cache
+            and state.app.config.get("ACCESS_MERGED_PERMISSION_CACHE")
+        ):
+            keys = [key for _, key in compiled.actions]
+            merged, generations = state.get_merged_action_cache(keys)
+            if merged is None:
+                merged = ActionExpansion.merge(
+                    self._expand_action(a, key) for a, key in compiled.actions
+                )
+                state.set_merged_action_cache(keys, generations, merged)
+            return self._merge_permissions(compiled, [merged])
+        return self._merge_permissions(compiled)
+
+    @property
+    def _permissions(self):
+        """The expansion of the permission, deprecated.
+
+        Kept for the subclasses which call ``_load_permissions()`` and then
+        read this attribute. The expansion is loaded on each access instead
+        of being kept on the permission, use the value returned by
+        ``_load_permissions()`` instead.
+        """
+        permissions = vars(self).get("_permissions")
+        if permissions is not None:
+            return permissions
+        warn(
+            "Permission._permissions is deprecated, use the value returned by "
+            "Permission._load_permissions() instead.",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        return self._load_permissions()
+
+    @_permissions.setter
+    def _permissions(self, permissions):
+        """Keep an expansion set by a subclass."""
+        vars(self)["_permissions"] = permissions
+
+    def _merge_permissions(self, compiled, expansions=None):
+        """Merge the explicit needs with the expansions of the actions.
+
+        :param compiled: The compiled permission.
+        :param expansions: The expansions of the actions, if they are
+            already loaded. (Default: ``None``)
+        """
+        if expansions is None:
+            expansions = (self._expand_action(a, key) for a, key in compiled.actions)
+        # merge all explicit needs/excludes with the needs/excludes of all
+        # the expanded ActionNeeds
+        result = ActionExpansion.merge(chain([compiled.explicit], expansions))
 
         # "allow_by_default = False" means that when needs are empty,
         # then it should deny access.
@@ -168,34 +338,177 @@ class Permission(_Permission):
         deny_access_when_empty_needs = not self.allow_by_default
         if needs_empty and deny_access_when_empty_needs:
             # Add at least one dummy need so that it will always deny access
-            result.needs.update(action_needs)
+            result = result._replace(needs=compiled.action_needs)
 
-        self._permissions = result
+        return result
 
-    def _expand_action(self, explicit_action):
+    def _expand_action(self, explicit_action, cache_key=None):
         """Expand action to user/roles needs and excludes."""
-        action = current_access.get_action_cache(self._cache_key(explicit_action))
+        state = current_access._get_current_object()
+        source = state.replica if state.replica is not None else state.snapshot
+        if source is not None:
+            action = source.expand(explicit_action)
+            if action is not None:
+                return action
+        if cache_key is None:
+            cache_key = self._cache_key(explicit_action)
+        action = current_access.get_action_cache(cache_key)
         if action is None:
-            action = _P(needs=set(), excludes=set())
-
-            actionsusers = ActionUsers.query_by_action(explicit_action).all()
+            action = self._query_action(explicit_action, cache_key)
+        return action
 
-            actionsroles = (
-                ActionRoles.query_by_action(explicit_action)
-                .join(ActionRoles.role)
-                .all()
+    def _query_action(self, explicit_action, cache_key):
+        """Expand action from the database and cache the expansion."""
+        argument = getattr(explicit_action, "argument", None)
+        params = {"action": explicit_action.value}
+        if argument is not None:
+            params["argument"] = str(argument)
+        union_all = argument is not None and use_argument_union_all()
+
+        grants = []
+        for model, owner, to_need in _GRANT_TABLES:
+            statement = _expansion_statement(
+                model, owner, argument is not None, union_all
+            )
+            grants.extend(
+                (exclude, to_need(value))
+                for exclude, value in execute_read(statement, params)
             )
+        action = ActionExpansion.from_grants(grants)
 
-            actionssystem = ActionSystemRoles.query_by_action(explicit_action).all()
+        current_access.set_action_cache(cache_key, action)
+        return action
 
-            for db_action in chain(actionsusers, actionsroles, actionssystem):
-                if db_action.exclude:
-                    action.excludes.add(db_action.need)
-                else:
-                    action.needs.add(db_action.need)
+    def allows(self, identity):
+        """Whether the identity can access this permission.
 
-            current_access.set_action_cache(self._cache_key(explicit_action), action)
-        return action
+        The explicit needs and excludes are checked first, then the actions
+        are expanded one at a time, those already in the action cache first,
+        and the evaluation stops as soon as an exclude denies access. If
+        ``ACCESS_BITSET_EVALUATION`` is enabled, the check is done on the
+        bitsets of the expanded actions instead. If ``ACCESS_REPLICA`` is
+        enabled, the actions are expanded from the in-process grant replica,
+        and if ``ACCESS_SNAPSHOT_PATH`` is set, from the grant snapshot.
+
+        :param identity: The identity
+        """
+        cls = type(self)
+        if cls.needs is not Permission.needs or cls.excludes is not Permission.excludes:
+            # the needs are computed by a subclass
+            return super(Permission, self).allows(identity)
+        if self._allows_system_process(identity):
+            return True
+        state = current_access._get_current_object()
+        if state.bitset_engine is not None:
+            return self._allows_bitsets(state, identity)
+
+        if state.app.config.get("ACCESS_MERGED_PERMISSION_CACHE"):
+            # expand the actions once for both the needs and the excludes
+            permissions = self._load_permissions()
+            provides = identity.provides
+            if permissions.needs and not permissions.needs.intersection(provides):
+                return False
+            if permissions.excludes and permissions.excludes.intersection(provides):
+                return False
+            return True
+        return self._allows_lazily(state, identity)
+
+    def _allows_system_process(self, identity):
+        """Check if a system process is explicitly allowed.
+
+        System processes, e.g. background jobs running as
+        :data:`system_identity`, are allowed without expanding any action if
+        the permission explicitly requires :data:`system_process` and does
+        not explicitly exclude it. Grants excluding the ``system_process``
+        role from an action are therefore not considered.
+        """
+        compiled = self.compile()
+        return (
+            system_process in compiled.explicit.needs
+            and system_process not in compiled.explicit.excludes
+            and system_process in identity.provides
+        )
+
+    def _allows_lazily(self, state, identity):
+        """Check an identity, expanding the actions only as far as needed."""
+        compiled = self.compile()
+        provides = identity.provides
+        explicit = compiled.explicit
+        if explicit.has_excludes and not explicit.excludes.isdisjoint(provides):
+            return False
+        has_needs = bool(explicit.needs)
+        allowed = not explicit.needs.isdisjoint(provides)
+
+        actions = compiled.actions
+        source = state.replica if state.replica is not None else state.snapshot
+        if source is not None:
+            expansions = [source.expand(action) for action, _ in actions]
+            # the actions which the replica or the snapshot can't expand,
+            # e.g. those changed since the snapshot was built, are expanded
+            # as usual
+            actions = [a for a, e in zip(actions, expansions) if e is None]
+        else:
+            expansions = []
+
+        # cached expansions are checked before the ones loaded from the database
+        cached = state.get_many_action_cache([k for _, k in actions]) if actions else ()
+        fetched = [e for e in chain(expansions, cached) if e is not None]
+        if (
+            len(fetched) == len(compiled.actions)
+            and not OPEN_NEEDS.isdisjoint(provides)
+            and not any(e.has_excludes for e in fetched)
+        ):
+            # nothing can deny access, so an action granted to a system role
+            # of the identity, e.g. to all users, allows it without any set
+            # operation on the other needs
+            for expansion in fetched:
+                if expansion.is_open and any(
+                    need in provides for need in expansion.open_needs
+                ):
+                    return True
+        missing = (
+            partial(self._query_action, action, key)
+            for (action, key), expansion in zip(actions, cached)
+            if expansion is None
+        )
+        for expansion in chain(fetched, (load() for load in missing)):
+            if expansion.has_excludes and not expansion.excludes.isdisjoint(provides):
+                return False
+            if expansion.needs:
+                has_needs = True
+                allowed = allowed or not expansion.needs.isdisjoint(provides)
+
+        if not has_needs:
+            # "allow_by_default = False" means that when needs are empty,
+            # then it should deny access.
+            return self.allow_by_default or not compiled.action_needs.isdisjoint(
+                provides
+            )
+        return allowed
+
+    def _allows_bitsets(self, state, identity):
+        """Check an identity with the bitsets of the expanded actions."""
+        engine = state.bitset_engine
+        compiled = self.compile()
+        generations = state.get_action_generations(key for _, key in compiled.actions)
+
+        index = engine.index
+        needs = index.mask(compiled.explicit.needs)
+        excludes = index.mask(compiled.explicit.excludes)
+        for (action, key), generation in zip(compiled.actions, generations):
+            bits = engine.get(
+                key, generation, partial(self._expand_action, action, key)
+            )
+            needs |= bits.needs
+            if bits.excludes:
+                excludes |= bits.excludes
+        if not needs and not self.allow_by_default:
+            needs = index.mask(compiled.action_needs)
+
+        provides = index.provides_mask(identity.provides)
+        if needs and not needs & provides:
+            return False
+        return not (excludes and excludes & provides)
 
     @property
     def needs(self):
@@ -203,8 +516,7 @@ class Permission(_Permission):
 
         :returns: A list of need instances.
         """
-        self._load_permissions()
-        return self._permissions.needs
+        return self._load_permissions().needs
 
     @property
     def excludes(self):
@@ -212,8 +524,69 @@ class Permission(_Permission):
 
         :returns: A list of need instances.
         """
-        self._load_permissions()
-        return self._permissions.excludes
+        return self._load_permissions().excludes
+
+
+def load_action_expansions(actions):
+    """Expand several actions and all their arguments at once.
+
+    Instead of three queries per action and argument, the grants of all
+    actions are loaded with one query per grant table.
+
+    :param actions: The action names.
+    :returns: A dictionary mapping action cache keys to the expanded needs and
+        excludes, as the permissions store them in the action cache.
+    """
+    actions = set(actions)
+    if not actions:
+        return {}
+    queries = (
+        db.session.query(
+            ActionUsers.action,
+            ActionUsers.argument,
+            ActionUsers.exclude,
+            ActionUsers.user_id,
+        ),
+        db.session.query(
+            ActionRoles.action,
+            ActionRoles.argument,
+            ActionRoles.exclude,
+            ActionRoles.role_id,
+        ).join(ActionRoles.role),
+        db.session.query(
+            ActionSystemRoles.action,
+            ActionSystemRoles.argument,
+            ActionSystemRoles.exclude,
+            ActionSystemRoles.role_name,
+        ),
+    )
+    to_need = (
+        int,
+        lambda role_id: intern_need(RoleNeed(role_id)),
+        lambda role_name: intern_need(current_access.system_roles[role_name]),
+    )
+
+    grants = {}
+    for query, need in zip(queries, to_need):
+        model = query.column_descriptions[0]["entity"]
+        query = query.filter(model.action.in_(actions))
+        for action, argument, exclude, owner in execute_read(query.statement):
+            grants.setdefault((action, argument), []).append((exclude, need(owner)))
+
+    expansions = {}
+    for action in actions:
+        expansions[get_action_cache_key(action, None)] = ActionExpansion.from_grants(
+            grants.get((action, None), ())
+        )
+    # grants without argument apply to all the arguments of an action
+    for (action, argument), action_grants in grants.items():
+        if argument is not None:
+            expansions[get_action_cache_key(action, argument)] = (
+                ActionExpansion.from_grants(
+                    chain(grants.get((action, None), ()), action_grants)
+                )
+            )
+    return expansions
 
 
 system_permission = Permission(system_process)
@@ -0,0 +1,260 @@
+# SPDX-FileCopyrightText: 2026 CERN.
+# SPDX-License-Identifier: MIT
+
+"""In-process replica of the grant tables.
+
+The :class:`GrantReplica` keeps the grants of the three grant tables in the
+memory of each process, indexed by action and argument, so that actions are
+expanded without any cache lookup or database query. It is loaded once with
+a streaming query per grant table, then kept up to date by polling the grant
+changelog, see :class:`invenio_access.models.AccessChangelog`, and reloading
+the grants of the changed actions.
+
+The replica is shared by all the sessions of the process, so it only reads
+committed grants, on its own connection to the read engine or the primary
+database. A session which changed grants shortly before expands the actions
+as usual instead, so that it sees its own changes, and so do all the sessions
+while the replica can't be loaded or kept up to date.
+"""
+
+import threading
+import time
+from itertools import chain
+
+import sqlalchemy as sa
+from flask import current_app
+from invenio_db import db
+
+from .expansions import ActionExpansion
+from .models import (
+    AccessChangelog,
+    ActionRoles,
+    connect_read,
+    grants_recently_written,
+)
+from .permissions import _GRANT_TABLES
+
+
+class GrantReplica(object):
+    """Keep all the grants in the memory of the current process."""
+
+    def __init__(self, interval=1, chunk_size=1000, overlap=1000, reload_interval=3600):
+        """Initialize the replica.
+
+        :param interval: Minimum number of seconds between two polls of the
+            grant changelog. (Default: ``1``)
+        :param chunk_size: Number of rows fetched per round trip while
+            loading the grants. (Default: ``1000``)
+        :param overlap: Number of sequence numbers before the last applied
+            change which are polled again. (Default: ``1000``)
+        :param reload_interval: Number of seconds after which all the grants
+            are loaded again, or ``None`` to never load them again.
+            (Default: ``3600``)
+        """
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.reload_interval = reload_interval
+        self.sequence = None
+        """Sequence of the last applied change, ``None`` until loaded."""
+        self.checked = None
+        """Time of the last poll of the changelog."""
+        self.loaded = None
+        """Time of the last load of all the grants."""
+        self.failed = None
+        """Time of the last failed refresh, ``None`` after a successful one."""
+        self._applied = frozenset()
+        self._grants = {}
+        self._expansions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Return the number of grants in the replica."""
+        return sum(
+            len(grants)
+            for arguments in self._grants.values()
+            for grants in arguments.values()
+        )
+
+    def _load_grants(self, connection, actions=None):
+        """Stream the grants of some actions, or of all of them.
+
+        The grants of system roles which are not registered are skipped.
+
+        :returns: A dictionary mapping actions to dictionaries mapping
+            arguments to lists of ``(exclude, need)`` pairs.
+        """
+        connection = connection.execution_options(yield_per=self.chunk_size)
+        grants = {}
+        unregistered = set()
+        for model, owner, to_need in _GRANT_TABLES:
+            statement = sa.select(
+                model.action, model.argument, model.exclude, getattr(model, owner)
+            )
+            if model is ActionRoles:
+                statement = statement.join(ActionRoles.role)
+            if actions is not None:
+                statement = statement.where(model.action.in_(actions))
+            for action, argument, exclude, value in connection.execute(statement):
+                try:
+                    need = to_need(value)
+                except KeyError:
+                    unregistered.add(value)
+                    continue
+                grants.setdefault(action, {}).setdefault(argument, []).append(
+                    (exclude, need)
+                )
+        if unregistered:
+            current_app.logger.warning(
+                "Skipped the grants of unregistered system roles: %s",
+                ", ".join(sorted(unregistered)),
+            )
+        return grants
+
+    def _window(self, sequence):
+        """Return the sequence after which the changelog is polled."""
+        return max(sequence - self.overlap, 0)
+
+    def _load(self):
+        """Load all the grants, the lock being held."""
+        with connect_read() as connection:
+            # changes committed while the grants are read are applied again
+            sequence = AccessChangelog.last_sequence(connection=connection)
+            changes = AccessChangelog.changes_since(
+                self._window(sequence), connection=connection
+            )
+            grants = self._load_grants(connection)
+        applied = {change[0] for change in changes}
+        self._grants = grants
+        self._expansions = {}
+        self.sequence = max(applied | {sequence})
+        self._applied = frozenset(applied)
+        self.checked = self.loaded = time.monotonic()
+        self.failed = None
+
+    def load(self):
+        """Load all the grants."""
+        with self._lock:
+            self._load()
+
+    def _reload_due(self):
+        """Check if all the grants must be loaded (again)."""
+        return self.sequence is None or (
+            self.reload_interval is not None
+            and time.monotonic() - self.loaded >= self.reload_interval
+        )
+
+    def refresh(self, force=False):
+        """Apply the grant changes logged since the last poll.
+
+        The grants of the changed actions are reloaded. Nothing is done if
+        the changelog was polled less than ``interval`` seconds before.
+
+        The sequence of a transaction is assigned before it commits, so a
+        change can be committed after changes with a higher sequence. The
+        last ``overlap`` sequence numbers are therefore polled again, and
+        the changes which were not applied yet are applied. A change
+        committed even later is only applied when all the grants are loaded
+        again, every ``reload_interval`` seconds.
+
+        A failed load or poll is logged, and retried after ``interval``
+        seconds.
+
+        :param force: If ``True``, poll the changelog regardless of the
+            interval. (Default: ``False``)
+        :returns: The number of applied changes.
+        """
+        if (
+            not force
+            and self.failed is not None
+            and time.monotonic() - self.failed < self.interval
+        ):
+            return 0
+        try:
+            return self._refresh(force)
+        except Exception:
+            self.failed = time.monotonic()
+            current_app.logger.exception("Grant replica refresh failed.")
+            return 0
+
+    def _refresh(self, force):
+        """Apply the grant changes logged since the last poll."""
+        if self._reload_due():
+            # until loaded, wait for the grants, then keep serving the
+            # loaded ones while another thread loads them again
+            if self._lock.acquire(blocking=self.sequence is None):
+                try:
+                    if self._reload_due():
+                        self._load()
+                finally:
+                    self._lock.release()
+            return 0
+        if not force and time.monotonic() - self.checked < self.interval:
+            return 0
+        with self._lock:
+            self.checked = time.monotonic()
+            with connect_read() as connection:
+                changes = [
+                    change
+                    for change in AccessChangelog.changes_since(
+                        self._window(self.sequence), connection=connection
+                    )
+                    if change[0] not in self._applied
+                ]
+                if not changes:
+                    self.failed = None
+                    return 0
+                actions = {action for _, action, _ in changes}
+                reloaded = self._load_grants(connection, actions)
+            grants = dict(self._grants)
+            for action in actions:
+                grants.pop(action, None)
+            grants.update(reloaded)
+            self._grants = grants
+            self._expansions = {
+                key: expansion
+                for key, expansion in self._expansions.items()
+                if key[0] not in actions
+            }
+            self.sequence = max(self.sequence, changes[-1][0])
+            window = self._window(self.sequence)
+            self._applied = frozenset(
+                sequence
+                for sequence in chain(self._applied, (c[0] for c in changes))
+                if sequence > window
+            )
+            self.failed = None
+            return len(changes)
+
+    def expand(self, action):
+        """Expand an action need from the replica.
+
+        The changelog is polled first if the interval is elapsed.
+
+        :param action: The action need, with an optional ``argument``.
+        :returns: An :class:`invenio_access.expansions.ActionExpansion`, or
+            ``None`` if grants were changed in the current session shortly
+            before, since the replica may not include these changes yet, or
+            if the last load or poll of the replica failed.
+        """
+        if grants_recently_written(db.session):
+            return None
+        self.refresh()
+        if self.sequence is None or self.failed is not None:
+            return None
+        # a concurrent refresh replaces the dictionaries instead of changing them
+        expansions = self._expansions
+        arguments = self._grants.get(action.value, {})
+        argument = getattr(action, "argument", None)
+        argument = None if argument is None else str(argument)
+        if argument not in arguments:
+            # only the grants without argument apply
+            argument = None
+        key = (action.value, argument)
+        expansion = expansions.get(key)
+        if expansion is None:
+            grants = arguments.get(None, ())
+            if argument is not None:
+                grants = chain(grants, arguments[argument])
+            expansion = expansions[key] = ActionExpansion.from_grants(grants)
+        return expansion
@@ -0,0 +1,220 @@
+# SPDX-FileCopyrightText: 2026 CERN.
+# SPDX-License-Identifier: MIT
+
+"""Serializers for the action cache entries.
+
+The expansion of an action, i.e. its needs and excludes, is serialized before
+being stored in the action cache and deserialized when it is read back. The
+serializer is configured with ``ACCESS_ACTION_CACHE_SERIALIZER``.
+"""
+
+import json
+import lzma
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections import Counter
+
+from flask_principal import Need
+
+from .expansions import ActionExpansion, NeedSet, intern_need
+
+
+class ActionCacheSerializer(object):
+    """Serializer storing the expansions as they are.
+
+    The cache backend is then responsible for serializing the values, which
+    for most backends means pickling them.
+    """
+
+    def __init__(self):
+        """Initialize the serializer."""
+        self.stats = Counter()
+        """Counters of the serializer in the current process."""
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a serializer from the application configuration.
+
+        :param config: The application configuration.
+        """
+        return cls()
+
+    def dumps(self, data):
+        """Serialize an expansion.
+
+        :param data: A ``(needs, excludes)`` pair.
+        :returns: The value to store in the cache.
+        """
+        return data
+
+    def loads(self, value):
+        """Deserialize an expansion.
+
+        :param value: The value read from the cache.
+        :returns: A ``(needs, excludes)`` pair or ``None`` if the value can't
+            be read by this serializer.
+        """
+        return value
+
+
+class CompactActionCacheSerializer(ActionCacheSerializer):
+    """Serializer storing the expansions in a compact, pickle-free format.
+
+    The stored value is made of a fixed header, the user ids of the needs and
+    of the excludes as packed little-endian 64-bit integers, and a JSON
+    document with the remaining needs (roles, system roles and any other
+    need) as short lists.
+
+    Values written with another format version are ignored, i.e. read as a
+    cache miss, so that the format can evolve without flushing the cache.
+
+    If a compression is given, values whose payload is larger than the
+    threshold are compressed, which is recorded in the header flags.
+    """
+
+    FLAG_ZLIB = 0x01
+    """Header flag of a payload compressed with zlib."""
+
+    FLAG_LZMA = 0x02
+    """Header flag of a payload compressed with lzma."""
+
+    compressions = {
+        "zlib": (FLAG_ZLIB, zlib.compress, zlib.decompress),
+        "lzma": (FLAG_LZMA, lzma.compress, lzma.decompress),
+    }
+    """Available compressions, with their flag and functions."""
+
+    MAGIC = b"IAC"
+    """Prefix identifying values written by this serializer."""
+
+    VERSION = 1
+    """Version of the format."""
+
+    header = struct.Struct("<3sBBII")
+    """Magic, version, flags and number of user ids in needs and excludes."""
+
+    def __init__(self, compression=None, compression_threshold=64 * 1024):
+        """Initialize the serializer.
+
+        :param compression: ``"zlib"``, ``"lzma"`` or ``None`` to disable the
+            compression. (Default: ``None``)
+        :param compression_threshold: Minimum size in bytes of the payload to
+            compress. (Default: ``65536``)
+        """
+        super(CompactActionCacheSerializer, self).__init__()
+        if compression is not None and compression not in self.compressions:
+            raise ValueError(f"Unknown compression '{compression}'.")
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a serializer from the application configuration."""
+        return cls(
+            compression=config.get("ACCESS_ACTION_CACHE_COMPRESSION"),
+            compression_threshold=config.get(
+                "ACCESS_ACTION_CACHE_COMPRESSION_THRESHOLD", 64 * 1024
+            ),
+        )
+
+    def _split(self, needs):
+        """Split needs into integer user ids and the other needs."""
+        if not isinstance(needs, NeedSet):
+            needs = NeedSet(needs)
+        others = {}
+        for need in needs.other_needs:
+            others.setdefault(need[0], []).append(list(need[1:]))
+        users = array("q", needs.user_ids)
+        if sys.byteorder == "big":
+            users.byteswap()
+        return users, others
+
+    def _join(self, users, others):
+        """Rebuild the needs from the user ids and the other needs.
+
+        The user ids are kept in their array, no ``UserNeed`` is created.
+        """
+        if sys.byteorder == "big":
+            users.byteswap()
+        needs = set()
+        for method, values in others.items():
+            for value in values:
+                if len(value) == 1:
+                    needs.add(intern_need(Need(method, value[0])))
+                else:
+                    needs.add(intern_need((method,) + tuple(value)))
+        return NeedSet.from_parts(users, frozenset(needs))
+
+    def encode(self, needs, excludes, flags=0):
+        """Encode needs and excludes.
+
+        :param needs: The needs.
+        :param excludes: The excludes.
+        :param flags: Flags stored in the header. (Default: ``0``)
+        :returns: The encoded bytes.
+        """
+        need_users, need_others = self._split(needs)
+        exclude_users, exclude_others = self._split(excludes)
+        others = json.dumps(
+            {"n": need_others, "x": exclude_others},
+            separators=(",", ":"),
+            sort_keys=True,
+        ).encode("utf-8")
+        payload = b"".join((need_users.tobytes(), exclude_users.tobytes(), others))
+        if self.compression and len(payload) >= self.compression_threshold:
+            flag, compress, _ = self.compressions[self.compression]
+            payload = compress(payload)
+            flags |= flag
+        header = self.header.pack(
+            self.MAGIC, self.VERSION, flags, len(need_users), len(exclude_users)
+        )
+        return header + payload
+
+    def decode(self, value):
+        """Decode a value written by :meth:`encode`.
+
+        :param value: The stored bytes.
+        :returns: A ``(flags, needs, excludes)`` tuple, or ``None`` if the
+            value was not written by this version of the serializer.
+        """
+        if not isinstance(value, bytes) or len(value) < self.header.size:
+            return None
+        magic, version, flags, n_needs, n_excludes = self.header.unpack_from(value)
+        if magic != self.MAGIC or version != self.VERSION:
+            return None
+        payload = value[self.header.size :]
+        for flag, _, decompress in self.compressions.values():
+            if flags & flag:
+                start = time.perf_counter()
+                payload = decompress(payload)
+                self.stats["decompressions"] += 1
+                self.stats["decompression_seconds"] += time.perf_counter() - start
+                self.stats["compressed_bytes"] += len(value) - self.header.size
+                self.stats["decompressed_bytes"] += len(payload)
+        offset = 0
+        need_users = array("q", payload[offset : offset + 8 * n_needs])
+        offset += 8 * n_needs
+        exclude_users = array("q", payload[offset : offset + 8 * n_excludes])
+        offset += 8 * n_excludes
+        others = json.loads(payload[offset:].decode("utf-8"))
+        return (
+            flags,
+            self._join(need_users, others["n"]),
+            self._join(exclude_users, others["x"]),
+        )
+
+    def dumps(self, data):
+        """Serialize an expansion."""
+        needs, excludes = data
+        return self.encode(needs, excludes)
+
+    def loads(self, value):
+        """Deserialize an expansion."""
+        decoded = self.decode(value)
+        if decoded is None:
+            return None
+        _, needs, excludes = decoded
+        return ActionExpansion(needs=needs, excludes=excludes)
@@ -0,0 +1,396 @@
+# SPDX-FileCopyrightText: 2026 CERN.
+# SPDX-License-Identifier: MIT
+
+"""Memory-mapped snapshots of the grants.
+
+A snapshot is a binary file holding the expansions of all the actions and of
+all their arguments, written by ``invenio access snapshot build``. The file
+is mapped in memory by each process with :mod:`mmap`, so all the processes
+of a host share one physical copy through the page cache, and the user ids
+of the expansions are read straight from the mapping as a
+:class:`invenio_access.expansions.NeedSet` over a ``memoryview``.
+
+All the integers are 64-bit and in the byte order of the host which built
+the file::
+
+    magic       8 bytes, "IACCESS" and a NUL byte
+    header      byte order mark, version, changelog sequence, number of
+                entries, of names, of user ids, of name ids, of applied
+                sequences, size of the string blob
+    entries     per action key, sorted by key: start and end of the key in
+                the blob, then start and end of the needs and of the
+                excludes, in the user ids and in the name ids
+    names       per other need: start and end of its method and of its
+                value in the blob
+    user ids    sorted user ids of each entry
+    name ids    sorted name ids of each entry
+    applied     sorted sequences of the changes included in the snapshot,
+                among the last sequence numbers polled again by the readers
+    blob        UTF-8 encoded keys and names
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from itertools import chain
+
+import sqlalchemy as sa
+from flask import current_app
+from flask_principal import ActionNeed, Need
+from invenio_db import db
+
+from .expansions import ActionExpansion, NeedSet, intern_need
+from .models import (
+    AccessChangelog,
+    ActionRoles,
+    ActionSystemRoles,
+    ActionUsers,
+    connect_read,
+    execute_read,
+    get_action_cache_key,
+    grants_recently_written,
+)
+from .permissions import load_action_expansions
+
+MAGIC = b"IACCESS\0"
+"""Magic bytes at the start of a snapshot."""
+
+VERSION = 2
+"""Version of the snapshot format."""
+
+_BOM = 0x0102030405060708
+_HEADER = struct.Struct("=8s9q")
+_ENTRY_WORDS = 10
+_NAME_WORDS = 4
+
+
+def _grant_actions():
+    """Return the names of all the actions having a grant."""
+    statement = sa.union(
+        *(
+            sa.select(model.action)
+            for model in (ActionUsers, ActionRoles, ActionSystemRoles)
+        )
+    )
+    return {row[0] for row in execute_read(statement)}
+
+
+def write_snapshot(stream, expansions, sequence=0, applied=()):
+    """Write a snapshot of expansions.
+
+    :param stream: A binary file object.
+    :param expansions: A dictionary mapping action cache keys to
+        expansions.
+    :param sequence: The sequence of the last grant change included in the
+        expansions. (Default: ``0``)
+    :param applied: The sequences of the grant changes included in the
+        expansions which the readers poll again. (Default: ``()``)
+    :returns: The number of written bytes.
+    """
+    blob = bytearray()
+    names = {}
+    name_words = array("q")
+
+    def add_string(value):
+        start = len(blob)
+        blob.extend(value.encode("utf-8"))
+        return start, len(blob)
+
+    def name_id(need):
+        if need not in names:
+            method, value = need
+            if not isinstance(value, str):
+                raise ValueError(f"Need {need!r} can't be stored in a snapshot.")
+            names[need] = len(names)
+            name_words.extend(add_string(method) + add_string(value))
+        return names[need]
+
+    entry_words, users, others = array("q"), array("q"), array("q")
+    for key in sorted(expansions, key=lambda k: k.encode("utf-8")):
+        entry_words.extend(add_string(key))
+        for needs in expansions[key]:
+            entry_words.extend((len(users), len(users) + len(needs.user_ids)))
+            users.extend(needs.user_ids)
+        for needs in expansions[key]:
+            ids = sorted(name_id(need) for need in needs.other_needs)
+            entry_words.extend((len(others), len(others) + len(ids)))
+            others.extend(ids)
+    applied = array("q", sorted(applied))
+
+    header = _HEADER.pack(
+        MAGIC,
+        _BOM,
+        VERSION,
+        sequence,
+        len(expansions),
+        len(names),
+        len(users),
+        len(others),
+        len(applied),
+        len(blob),
+    )
+    parts = (entry_words, name_words, users, others, applied)
+    for part in (header, *parts, blob):
+        stream.write(part)
+    return len(header) + 8 * sum(map(len, parts)) + len(blob)
+
+
+def build_snapshot(path, overlap=1000):
+    """Write a snapshot of all the grants to a file.
+
+    The file is written next to its destination and renamed, so that the
+    processes mapping the previous snapshot keep reading it until they map
+    the new one.
+
+    :param path: The path of the snapshot.
+    :param overlap: Number of sequence numbers before the last change which
+        are polled again by the readers. (Default: ``1000``)
+    :returns: A tuple ``(entries, size)`` with the number of action keys and
+        the size of the file in bytes.
+    """
+    # changes committed while the grants are read are applied again
+    with connect_read() as connection:
+        sequence = AccessChangelog.last_sequence(connection=connection)
+        changes = AccessChangelog.changes_since(
+            max(sequence - overlap, 0), connection=connection
+        )
+    applied = {change[0] for change in changes}
+    sequence = max(applied | {sequence})
+    expansions = load_action_expansions(_grant_actions())
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as stream:
+            size = write_snapshot(stream, expansions, sequence, applied)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(expansions), size
+
+
+class ACLSnapshot(object):
+    """Read-only view of a snapshot file mapped in memory."""
+
+    def __init__(self, path):
+        """Map a snapshot file.
+
+        :param path: The path of the snapshot.
+        :raises ValueError: If the file is not a snapshot of a supported
+            version built on a host of the same byte order.
+        """
+        with open(path, "rb") as stream:
+            self._mmap = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < _HEADER.size:
+            raise ValueError(f"{path} is not an access snapshot.")
+        header = _HEADER.unpack_from(self._mmap)
+        magic, bom, version, self.sequence = header[:4]
+        entries, names, users, others, applied, blob_size = header[4:]
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an access snapshot.")
+        if bom != _BOM:
+            raise ValueError(f"{path} was built on a host of another byte order.")
+        if version != VERSION:
+            raise ValueError(f"{path} has unsupported version {version}.")
+
+        sizes = (_ENTRY_WORDS * entries, _NAME_WORDS * names, users, others, applied)
+        end = _HEADER.size + 8 * sum(sizes)
+        buffer = memoryview(self._mmap)
+        words = buffer[_HEADER.size : end].cast("q")
+        parts, start = [], 0
+        for size in sizes:
+            parts.append(words[start : start + size])
+            start += size
+        self._entries, self._names, self._users, self._others = parts[:4]
+        self.applied = frozenset(parts[4])
+        """Sequences of the changes included in the snapshot, which are
+        polled again."""
+        self._blob = buffer[end : end + blob_size]
+        self._need_cache = {}
+
+    def __len__(self):
+        """Return the number of action keys."""
+        return len(self._entries) // _ENTRY_WORDS
+
+    def _string(self, start, end):
+        """Decode a string of the blob."""
+        return str(self._blob[start:end], "utf-8")
+
+    def _need(self, name_id):
+        """Return the interned need of a name id."""
+        need = self._need_cache.get(name_id)
+        if need is None:
+            words = self._names[name_id * _NAME_WORDS : (name_id + 1) * _NAME_WORDS]
+            need = intern_need(
+                Need(self._string(words[0], words[1]), self._string(words[2], words[3]))
+            )
+            self._need_cache[name_id] = need
+        return need
+
+    def _find(self, key):
+        """Return the index of an action key, or ``-1``."""
+        key = key.encode("utf-8")
+        entries, blob = self._entries, self._blob
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle * _ENTRY_WORDS
+            found = blob[entries[offset] : entries[offset + 1]].tobytes()
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return middle
+        return -1
+
+    def get(self, key):
+        """Get the expansion of an action key.
+
+        :param key: The action cache key.
+        :returns: An :class:`invenio_access.expansions.ActionExpansion`
+            whose user ids are read from the mapping, or ``None`` if the key
+            is not in the snapshot.
+        """
+        index = self._find(key)
+        if index < 0:
+            return None
+        words = self._entries[index * _ENTRY_WORDS : (index + 1) * _ENTRY_WORDS]
+        return ActionExpansion(
+            needs=NeedSet.from_parts(
+                self._users[words[2] : words[3]],
+                frozenset(map(self._need, self._others[words[6] : words[7]])),
+            ),
+            excludes=NeedSet.from_parts(
+                self._users[words[4] : words[5]],
+                frozenset(map(self._need, self._others[words[8] : words[9]])),
+            ),
+        )
+
+
+class SnapshotReader(object):
+    """Expand actions from the snapshot file of the current process."""
+
+    def __init__(self, path, interval=10, overlap=1000):
+        """Initialize the reader.
+
+        :param path: The path of the snapshot.
+        :param interval: Minimum number of seconds between two checks of
+            the snapshot file and of the grant changelog. (Default: ``10``)
+        :param overlap: Number of sequence numbers before the last seen
+            change which are polled again. (Default: ``1000``)
+        """
+        self.path = path
+        self.interval = interval
+        self.overlap = overlap
+        self.snapshot = None
+        """The mapped :class:`ACLSnapshot`, ``None`` until loaded."""
+        self.stale_actions = frozenset()
+        """Actions changed since the snapshot was built."""
+        self.checked = None
+        self._file_id = None
+        self._sequence = None
+        self._applied = frozenset()
+        self._expansions = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Map the snapshot file if it was replaced since it was last mapped.
+
+        :raises OSError: If the file can't be read.
+        :raises ValueError: If the file is not a supported snapshot.
+        """
+        stat = os.stat(self.path)
+        file_id = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+        if file_id != self._file_id:
+            snapshot = ACLSnapshot(self.path)
+            self.snapshot, self._file_id = snapshot, file_id
+            self._sequence = snapshot.sequence
+            self._applied = snapshot.applied
+            self.stale_actions = frozenset()
+            self._expansions = {}
+
+    def refresh(self, force=False):
+        """Check the snapshot file and the grant changelog.
+
+        The snapshot is mapped again if the file was replaced, and the
+        actions changed since it was built are marked as stale. Nothing is
+        done if they were checked less than ``interval`` seconds before.
+
+        As for :class:`invenio_access.replica.GrantReplica`, the last
+        ``overlap`` sequence numbers are polled again, so that the changes
+        committed after changes with a higher sequence are seen.
+
+        If the file is missing or is not a supported snapshot, the error is
+        logged and the snapshot mapped before, if any, is kept: the actions
+        changed since it was built are still marked as stale.
+
+        :param force: If ``True``, check them regardless of the interval.
+            (Default: ``False``)
+        """
+        if (
+            not force
+            and self.checked is not None
+            and time.monotonic() - self.checked < self.interval
+        ):
+            return
+        with self._lock:
+            self.checked = time.monotonic()
+            try:
+                self.load()
+            except (OSError, ValueError) as error:
+                current_app.logger.warning(
+                    "Could not map the grant snapshot %s: %s", self.path, error
+                )
+            if self.snapshot is None:
+                return
+            with connect_read() as connection:
+                changes = [
+                    change
+                    for change in AccessChangelog.changes_since(
+                        max(self._sequence - self.overlap, 0), connection=connection
+                    )
+                    if change[0] not in self._applied
+                ]
+            if changes:
+                self.stale_actions |= {action for _, action, _ in changes}
+                self._sequence = max(self._sequence, changes[-1][0])
+                window = max(self._sequence - self.overlap, 0)
+                self._applied = frozenset(
+                    sequence
+                    for sequence in chain(self._applied, (c[0] for c in changes))
+                    if sequence > window
+                )
+
+    def expand(self, action):
+        """Expand an action need from the snapshot.
+
+        :param action: The action need, with an optional ``argument``.
+        :returns: An :class:`invenio_access.expansions.ActionExpansion`, or
+            ``None`` if no snapshot could be mapped, if the action changed
+            since the snapshot was built, or if grants were changed in the
+            current session shortly before.
+        """
+        if grants_recently_written(db.session):
+            return None
+        self.refresh()
+        if self.snapshot is None or action.value in self.stale_actions:
+            return None
+        argument = getattr(action, "argument", None)
+        key = get_action_cache_key(action.value, argument)
+        # a refresh replaces the dictionary instead of changing it
+        expansions = self._expansions
+        expansion = expansions.get(key)
+        if expansion is None:
+            expansion = self.snapshot.get(key)
+            if expansion is None and argument is not None:
+                # only the grants without argument apply
+                return self.expand(ActionNeed(action.value))
+            if expansion is None:
+                expansion = ActionExpansion()
+            expansions[key] = expansion
+        return expansion
@@ -17,6 +17,8 @@ from flask_principal import ActionNeed, identity_loaded
 from invenio_accounts import InvenioAccounts
 from invenio_db import InvenioDB, db
 from invenio_i18n import InvenioI18N
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.schema import DropConstraint, DropSequence, DropTable
 
@@ -40,6 +42,19 @@ def _compile_drop_sequence(element, compiler, **kwargs):
     return compiler.visit_drop_sequence(element) + " CASCADE"
 
 
+@pytest.fixture()
+def sql_statements():
+    """List of the SQL statements executed on any engine during the test."""
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", record)
+    yield statements
+    event.remove(Engine, "before_cursor_execute", record)
+
+
 @pytest.fixture()
 def base_app():
     """Flask base application fixture."""
@@ -3,14 +3,30 @@
 
 """Module tests."""
 
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import sqlalchemy as sa
+from cachelib import SimpleCache
 from flask import g
-from flask_principal import ActionNeed
+from flask_principal import ActionNeed, Identity, UserNeed
 from flask_security.core import _security
 from flask_security.utils import login_user
 from invenio_accounts.cli import roles_add, roles_create, users_create
+from invenio_accounts.models import User
+from invenio_db import db
 
+from invenio_access import current_access
 from invenio_access.cli import access
-from invenio_access.permissions import ParameterizedActionNeed
+from invenio_access.models import (
+    AccessChangelog,
+    ActionRoles,
+    ActionSystemRoles,
+    ActionUsers,
+)
+from invenio_access.permissions import ParameterizedActionNeed, Permission, any_user
+from invenio_access.snapshot import ACLSnapshot, SnapshotReader
 
 
 def test_access_cli_allow_action_empty(cli_app):
@@ -270,3 +286,469 @@ def test_access_matrix(cli_app, dynamic_permission):
     )
     assert result.exit_code == 0
     assert result.output == ""
+
+
+def test_access_cli_export_import(cli_app, tmp_path):
+    """Test bulk export and import of grants."""
+    runner = cli_app.test_cli_runner()
+    result = runner.invoke(users_create, ["a@example.org", "--password", "123456"])
+    assert result.exit_code == 0
+    result = runner.invoke(roles_create, ["opener"])
+    assert result.exit_code == 0
+
+    for args in (
+        ["allow-action-for-user", "--user", "a@example.org", "--action", "open"],
+        ["deny-action-for-role", "--role", "opener", "--action", "edit", "-a", "1"],
+    ):
+        result = runner.invoke(access, args)
+        assert result.exit_code == 0
+    with cli_app.app_context():
+        db.session.add(ActionSystemRoles.allow(ActionNeed("open"), role=any_user))
+        db.session.commit()
+
+    for fmt in ("jsonl", "csv"):
+        path = tmp_path / f"grants.{fmt}"
+        result = runner.invoke(access, ["export", "-f", fmt, "-o", str(path)])
+        assert result.exit_code == 0
+        assert "Exported 3 grants" in result.output
+
+        with cli_app.app_context():
+            for model in (ActionUsers, ActionRoles, ActionSystemRoles):
+                model.query.delete()
+            db.session.commit()
+
+        result = runner.invoke(
+            access, ["import", "-f", fmt, "--chunk-size", "2", str(path)]
+        )
+        assert result.exit_code == 0
+        assert "Imported 3 grants" in result.output
+
+        # Importing twice does not duplicate any grant.
+        result = runner.invoke(access, ["import", "-f", fmt, str(path)])
+        assert result.exit_code == 0
+        assert "Imported 0 grants" in result.output
+
+        with cli_app.app_context():
+            assert ActionUsers.query.filter_by(action="open").count() == 1
+            role_grant = ActionRoles.query.one()
+            assert (role_grant.action, role_grant.argument) == ("edit", "1")
+            assert role_grant.exclude
+            assert ActionSystemRoles.query.one().role_name == "any_user"
+
+
+def test_access_cli_import_unknown_owner(cli_app, tmp_path):
+    """Test that grants of unknown owners are skipped on import."""
+    runner = cli_app.test_cli_runner()
+    path = tmp_path / "grants.jsonl"
+    path.write_text(
+        '{"type": "user", "owner": "x@example.org", "action": "open"}\n'
+        '{"type": "system_role", "owner": "any_user", "action": "open"}\n'
+    )
+    result = runner.invoke(access, ["import", str(path)])
+    assert result.exit_code == 0
+    assert "Skipped grants of unknown user 'x@example.org'" in result.output
+    assert "Imported 1 grants" in result.output
+
+
+def test_access_cli_sync(cli_app, tmp_path):
+    """Test that sync applies only the difference to the desired state."""
+    runner = cli_app.test_cli_runner()
+    for email in ("a@example.org", "b@example.org"):
+        result = runner.invoke(users_create, [email, "--password", "123456"])
+        assert result.exit_code == 0
+    for args in (
+        ["allow-action-for-user", "--user", "a@example.org", "--action", "open"],
+        ["allow-action-for-user", "--user", "b@example.org", "--action", "edit"],
+    ):
+        result = runner.invoke(access, args)
+        assert result.exit_code == 0
+
+    cli_app.extensions["invenio-access"].cache = SimpleCache()
+    cached = ({UserNeed(42)}, set())
+    with cli_app.app_context():
+        current_access.set_action_cache("open", cached)
+        current_access.set_action_cache("edit", cached)
+
+    path = tmp_path / "acl.jsonl"
+    path.write_text(
+        '{"type": "user", "owner": "a@example.org", "action": "open"}\n'
+        '{"type": "user", "owner": "b@example.org", "action": "edit",'
+        ' "argument": "1", "exclude": true}\n'
+        '{"type": "system_role", "owner": "any_user", "action": "open"}\n'
+    )
+    result = runner.invoke(access, ["sync", "--dry-run", str(path)])
+    assert result.exit_code == 0
+    assert "Would apply 2 inserts and 1 deletes (1 grants unchanged)" in result.output
+    with cli_app.app_context():
+        assert ActionUsers.query.count() == 2
+
+    result = runner.invoke(access, ["sync", str(path)])
+    assert result.exit_code == 0
+    assert "Applied 2 inserts and 1 deletes (1 grants unchanged)" in result.output
+    with cli_app.app_context():
+        grants = {(g.action, g.argument, g.exclude) for g in ActionUsers.query}
+        assert grants == {("open", None, False), ("edit", "1", True)}
+        assert ActionSystemRoles.query.one().role_name == "any_user"
+        # only the changed actions have been invalidated
+        assert current_access.get_action_cache("edit") is None
+        assert current_access.get_action_cache("open") is None
+        current_access.set_action_cache("open", cached)
+        current_access.set_action_cache("edit", cached)
+
+    result = runner.invoke(access, ["sync", str(path)])
+    assert result.exit_code == 0
+    assert "Applied 0 inserts and 0 deletes (3 grants unchanged)" in result.output
+    with cli_app.app_context():
+        assert current_access.get_action_cache("open") == cached
+        assert current_access.get_action_cache("edit") == cached
+
+
+def test_access_cli_multiple_targets(cli_app, tmp_path):
+    """Test granting and removing an action for several users and roles."""
+    runner = cli_app.test_cli_runner()
+    emails = [f"user{i}@example.org" for i in range(4)]
+    for email in emails:
+        result = runner.invoke(users_create, [email, "--password", "123456"])
+        assert result.exit_code == 0
+    for role in ("r1", "r2"):
+        result = runner.invoke(roles_create, [role])
+        assert result.exit_code == 0
+
+    path = tmp_path / "users.txt"
+    path.write_text("# onboarding\n" + "\n".join(emails[2:]) + "\n")
+    args = ["--action", "open", "--user", emails[0], "--user", emails[1]]
+    result = runner.invoke(
+        access, ["allow-action-for-user", "--user-file", str(path)] + args
+    )
+    assert result.exit_code == 0
+    # granting again skips the existing grants
+    result = runner.invoke(access, ["allow-action-for-user"] + args)
+    assert result.exit_code == 0
+    result = runner.invoke(
+        access, ["deny-action-for-role", "--role", "r1", "--role", "r2"] + args[:2]
+    )
+    assert result.exit_code == 0
+    with cli_app.app_context():
+        assert ActionUsers.query.filter_by(action="open").count() == 4
+        assert ActionRoles.query.filter_by(action="open", exclude=True).count() == 2
+
+    # nothing is written if one of the users does not exist
+    result = runner.invoke(
+        access,
+        ["deny-action-for-user", "--action", "edit"]
+        + ["--user", emails[0], "--user", "unknown@example.org"],
+    )
+    assert result.exit_code != 0
+    assert "unknown@example.org" in result.output
+    result = runner.invoke(access, ["deny-action-for-user", "--action", "edit"])
+    assert result.exit_code != 0
+    with cli_app.app_context():
+        assert ActionUsers.query.filter_by(action="edit").count() == 0
+
+    result = runner.invoke(access, ["remove-action-from-user"] + args)
+    assert result.exit_code == 0
+    result = runner.invoke(
+        access, ["remove-action-from-role", "--role", "r1"] + args[:2]
+    )
+    assert result.exit_code == 0
+    with cli_app.app_context():
+        assert {u.user.email for u in ActionUsers.query} == set(emails[2:])
+        assert ActionRoles.query.one().role.name == "r2"
+
+
+def test_access_cli_show(cli_app):
+    """Test filtering and formatting of the shown grants."""
+    runner = cli_app.test_cli_runner()
+    result = runner.invoke(users_create, ["a@example.org", "--password", "123456"])
+    assert result.exit_code == 0
+    result = runner.invoke(roles_create, ["opener"])
+    assert result.exit_code == 0
+    for args in (
+        ["allow-action-for-user", "--user", "a@example.org", "--action", "open"],
+        ["deny-action-for-user", "--user", "a@example.org", "--action", "edit"],
+        ["allow-action-for-role", "--role", "opener", "--action", "open"],
+    ):
+        result = runner.invoke(access, args)
+        assert result.exit_code == 0
+    with cli_app.app_context():
+        db.session.add(ActionSystemRoles.allow(ActionNeed("open"), role=any_user))
+        db.session.commit()
+
+    result = runner.invoke(access, ["show", "-s", "any_user"])
+    assert result.exit_code == 0
+    assert result.output == "system_role:any_user:open::allow\n"
+
+    result = runner.invoke(access, ["show", "--action", "open"])
+    assert result.exit_code == 0
+    assert result.output.splitlines() == [
+        "user:a@example.org:open::allow",
+        "role:opener:open::allow",
+        "system_role:any_user:open::allow",
+    ]
+
+    result = runner.invoke(
+        access, ["show", "-e", "a@example.org", "--limit", "1", "--format", "json"]
+    )
+    assert result.exit_code == 0
+    assert [json.loads(line) for line in result.output.splitlines()] == [
+        {
+            "action": "open",
+            "argument": None,
+            "exclude": False,
+            "owner": "a@example.org",
+            "type": "user",
+        }
+    ]
+
+    result = runner.invoke(access, ["show"])
+    assert result.exit_code == 0
+    assert result.output == ""
+
+
+def test_access_cli_cache(cli_app):
+    """Test the action cache commands."""
+    runner = cli_app.test_cli_runner()
+    result = runner.invoke(users_create, ["a@example.org", "--password", "123456"])
+    assert result.exit_code == 0
+    for args in (
+        ["allow-action-for-user", "--user", "a@example.org", "--action", "open"],
+        ["deny-action-for-user", "--user", "a@example.org", "--action", "edit"],
+        ["allow-action-for-user", "--user", "a@example.org"]
+        + ["--action", "edit", "-a", "1"],
+    ):
+        result = runner.invoke(access, args)
+        assert result.exit_code == 0
+    cli_app.extensions["invenio-access"].cache = SimpleCache()
+
+    result = runner.invoke(access, ["cache", "inspect", "open"])
+    assert result.exit_code != 0
+
+    actions = ["--action", "open", "--action", "edit"]
+    result = runner.invoke(access, ["cache", "warm"] + actions)
+    assert result.exit_code == 0
+    assert "Cached 3 entries" in result.output
+    with cli_app.app_context():
+        user_id = User.query.one().id
+        assert current_access.get_action_cache("open") == ({UserNeed(user_id)}, set())
+        assert current_access.get_action_cache("edit") == (set(), {UserNeed(user_id)})
+        assert current_access.get_action_cache("edit::1") == (
+            {UserNeed(user_id)},
+            {UserNeed(user_id)},
+        )
+        # the warmed entries are the ones the permissions would compute
+        for need in (ActionNeed("open"), ParameterizedActionNeed("edit", "1")):
+            key = Permission._cache_key(need)
+            cached = current_access.get_action_cache(key)
+            current_access.delete_action_cache(key)
+            assert Permission(need)._expand_action(need) == cached
+
+    result = runner.invoke(access, ["cache", "inspect", "edit::1"])
+    assert result.exit_code == 0
+    assert result.output == f"need:id:{user_id}\nexclude:id:{user_id}\n"
+
+    result = runner.invoke(access, ["cache", "stats"] + actions)
+    assert result.exit_code == 0
+    assert "Entries: 3 cached out of 3 known keys." in result.output
+    assert "hit rate: " in result.output
+
+    result = runner.invoke(access, ["cache", "flush", "--action", "edit"])
+    assert result.exit_code == 0
+    assert "Invalidated 2 entries." in result.output
+    result = runner.invoke(access, ["cache", "stats"] + actions)
+    assert "Entries: 1 cached out of 3 known keys." in result.output
+
+
+def test_access_cli_changelog(cli_app):
+    """Test that grant changes are logged and applied to the cache."""
+    runner = cli_app.test_cli_runner()
+    result = runner.invoke(users_create, ["a@example.org", "--password", "123456"])
+    assert result.exit_code == 0
+    for args in (
+        ["allow-action-for-user", "--user", "a@example.org", "--action", "open"],
+        ["allow-action-for-user", "--user", "a@example.org"]
+        + ["--action", "edit", "-a", "1"],
+    ):
+        result = runner.invoke(access, args)
+        assert result.exit_code == 0
+    with cli_app.app_context():
+        changes = AccessChangelog.changes_since(0)
+        assert [change[1:] for change in changes] == [("open", None), ("edit", "1")]
+        assert AccessChangelog.last_sequence() == changes[-1][0]
+
+    cli_app.extensions["invenio-access"].cache = SimpleCache()
+    # the first sync starts from the end of the changelog
+    result = runner.invoke(access, ["cache", "sync"])
+    assert result.exit_code == 0
+    assert "Applied 0 grant changes." in result.output
+
+    cached = ({UserNeed(42)}, set())
+    with cli_app.app_context():
+        for key in ("open", "edit", "edit::1"):
+            current_access.set_action_cache(key, cached)
+        with db.session.begin_nested():
+            db.session.add(ActionSystemRoles.allow(ActionNeed("edit"), role=any_user))
+        db.session.commit()
+        # the ORM events only invalidate the changed key
+        assert current_access.get_action_cache("edit") is None
+        assert current_access.get_action_cache("edit::1") == cached
+        current_access.set_action_cache("edit", cached)
+
+    result = runner.invoke(access, ["cache", "sync"])
+    assert result.exit_code == 0
+    assert "Applied 1 grant changes." in result.output
+    with cli_app.app_context():
+        assert current_access.get_action_cache("edit") is None
+        assert current_access.get_action_cache("edit::1") is None
+        assert current_access.get_action_cache("open") == cached
+
+    result = runner.invoke(access, ["remove-action-global", "--action", "open"])
+    assert result.exit_code == 0
+    result = runner.invoke(access, ["cache", "sync"])
+    assert "Applied 1 grant changes." in result.output
+
+    result = runner.invoke(access, ["changelog", "prune"])
+    assert result.exit_code == 2
+    with cli_app.app_context():
+        sequences = [change[0] for change in AccessChangelog.changes_since(0)]
+        assert len(sequences) == 4
+        # the first two changes were logged two days ago
+        db.session.execute(
+            sa.update(AccessChangelog)
+            .where(AccessChangelog.id <= sequences[1])
+            .values(
+                created=datetime.now(timezone.utc).replace(tzinfo=None)
+                - timedelta(days=2)
+            )
+        )
+        db.session.commit()
+
+    def prune(*args):
+        result = runner.invoke(access, ["changelog", "prune", *args])
+        assert result.exit_code == 0
+        with cli_app.app_context():
+            remaining = [change[0] for change in AccessChangelog.changes_since(0)]
+        return result.output, remaining
+
+    assert prune("--older-than", "3") == ("Deleted 0 grant changes.\n", sequences)
+    assert prune("--older-than", "1", "--keep", "3") == (
+        "Deleted 1 grant changes.\n",
+        sequences[1:],
+    )
+    assert prune("--keep", "2") == ("Deleted 1 grant changes.\n", sequences[2:])
+    # the last change is kept, so that the sequence never goes back
+    assert prune("--keep", "0") == ("Deleted 1 grant changes.\n", sequences[3:])
+    result = runner.invoke(access, ["remove-action-global", "--action", "open"])
+    with cli_app.app_context():
+        assert AccessChangelog.last_sequence() > sequences[3]
+
+
+def test_access_cli_snapshot(cli_app, tmp_path, caplog, sql_statements):
+    """Test that permissions are checked against a built snapshot."""
+    runner = cli_app.test_cli_runner()
+    for email in ("a@example.org", "b@example.org"):
+        result = runner.invoke(users_create, [email, "--password", "123456"])
+        assert result.exit_code == 0
+    for args in (
+        ["allow-action-for-user", "--user", "a@example.org", "--action", "open"],
+        ["allow-action-for-user", "--user", "b@example.org"]
+        + ["--action", "open", "-a", "1"],
+        ["deny-action-for-user", "--user", "a@example.org"]
+        + ["--action", "open", "-a", "1"],
+    ):
+        result = runner.invoke(access, args)
+        assert result.exit_code == 0
+
+    result = runner.invoke(access, ["snapshot", "build"])
+    assert result.exit_code != 0
+    path = tmp_path / "acl.snapshot"
+    result = runner.invoke(access, ["snapshot", "build", "-o", str(path)])
+    assert result.exit_code == 0
+    assert "Wrote 2 entries" in result.output
+
+    cli_app.config["ACCESS_SNAPSHOT_PATH"] = str(path)
+    cli_app.extensions["invenio-access"].cache = SimpleCache()
+    with cli_app.app_context():
+        user_a, user_b = (
+            User.query.filter_by(email=email).one().id
+            for email in ("a@example.org", "b@example.org")
+        )
+        reader = current_access.snapshot
+        open_1 = reader.expand(ParameterizedActionNeed("open", "1"))
+        assert open_1 == ({UserNeed(user_a), UserNeed(user_b)}, {UserNeed(user_a)})
+        # the user ids are read from the mapped file
+        assert isinstance(open_1.needs.user_ids, memoryview)
+        assert reader.expand(ParameterizedActionNeed("open", "2")) == (
+            {UserNeed(user_a)},
+            set(),
+        )
+
+        sql_statements.clear()
+        current_access.stats.clear()
+        identity_a, identity_b = Identity(user_a), Identity(user_b)
+        identity_a.provides.add(UserNeed(user_a))
+        identity_b.provides.add(UserNeed(user_b))
+        assert Permission(ActionNeed("open")).allows(identity_a)
+        assert not Permission(ActionNeed("open")).allows(identity_b)
+        assert not Permission(ParameterizedActionNeed("open", 1)).allows(identity_a)
+        assert Permission(ParameterizedActionNeed("open", 1)).allows(identity_b)
+        assert not Permission(ActionNeed("edit")).allows(identity_a)
+        assert not sql_statements and not current_access.stats
+
+    # the actions changed since the snapshot was built are expanded as usual
+    result = runner.invoke(
+        access, ["allow-action-for-user", "--user", "b@example.org", "--action", "open"]
+    )
+    assert result.exit_code == 0
+    with cli_app.app_context():
+        current_access.snapshot.checked = None
+        assert Permission(ActionNeed("open")).allows(identity_b)
+        assert current_access.snapshot.stale_actions == {"open"}
+
+    # a new snapshot is mapped when the file is replaced
+    result = runner.invoke(access, ["snapshot", "build", "-o", str(path)])
+    assert result.exit_code == 0
+    with cli_app.app_context():
+        current_access.snapshot.checked = None
+        assert current_access.snapshot.expand(ActionNeed("open")) == (
+            {UserNeed(user_a), UserNeed(user_b)},
+            set(),
+        )
+        assert not current_access.snapshot.stale_actions
+
+    # changes committed after changes with a higher sequence are seen
+    with cli_app.app_context():
+        reader = current_access.snapshot
+        sequence = AccessChangelog.last_sequence()
+        changelog = AccessChangelog.__table__
+        db.session.execute(changelog.insert(), [{"id": sequence + 2, "action": "edit"}])
+        db.session.commit()
+        reader.refresh(force=True)
+        assert reader.stale_actions == {"edit"}
+        db.session.execute(
+            ActionUsers.__table__.delete().where(
+                ActionUsers.user_id == user_b, ActionUsers.argument.is_(None)
+            )
+        )
+        db.session.execute(changelog.insert(), [{"id": sequence + 1, "action": "open"}])
+        db.session.commit()
+        reader.refresh(force=True)
+        assert reader.stale_actions == {"edit", "open"}
+        assert reader.expand(ActionNeed("open")) is None
+
+    # a missing or invalid file is logged and the actions expanded as usual
+    state = cli_app.extensions["invenio-access"]
+    with cli_app.app_context():
+        state.snapshot = SnapshotReader(str(tmp_path / "missing.snapshot"))
+        assert state.snapshot.expand(ActionNeed("open")) is None
+        assert Permission(ActionNeed("open")).allows(identity_b)
+    assert "Could not map the grant snapshot" in caplog.text
+
+    path.write_bytes(b"not a snapshot")
+    with pytest.raises(ValueError):
+        ACLSnapshot(str(path))
+    caplog.clear()
+    with cli_app.app_context():
+        state.snapshot = SnapshotReader(str(path))
+        assert state.snapshot.expand(ActionNeed("open")) is None
+        assert Permission(ActionNeed("open")).allows(identity_b)
+    assert "is not an access snapshot" in caplog.text
@@ -0,0 +1,184 @@
+# SPDX-FileCopyrightText: 2026 CERN.
+# SPDX-License-Identifier: MIT
+
+"""Compact expansions tests."""
+
+import pickle
+
+import pytest
+from flask_principal import Identity, RoleNeed, UserNeed
+
+from invenio_access.expansions import (
+    ActionExpansion,
+    NeedSet,
+    intern_need,
+)
+from invenio_access.permissions import (
+    ParameterizedActionNeed,
+    Permission,
+    any_user,
+    authenticated_user,
+)
+
+
+def test_need_set():
+    """Test the set interface of a need set."""
+    needs = {UserNeed(3), UserNeed(1), UserNeed("system"), RoleNeed("admin"), any_user}
+    need_set = NeedSet(needs)
+
+    assert list(need_set.user_ids) == [1, 3]
+    assert need_set.other_needs == {UserNeed("system"), RoleNeed("admin"), any_user}
+    assert len(need_set) == 5
+    assert need_set == needs and needs == need_set
+    assert need_set != needs | {UserNeed(2)}
+    assert hash(need_set) == hash(NeedSet(needs))
+    assert set(need_set) == needs
+    for need in needs:
+        assert need in need_set
+    for need in (UserNeed(2), UserNeed(0), UserNeed(4), authenticated_user, 1, None):
+        assert need not in need_set
+    assert pickle.loads(pickle.dumps(need_set)) == need_set
+
+
+def test_need_set_operations():
+    """Test the set operations of a need set."""
+    need_set = NeedSet([UserNeed(i) for i in range(0, 100, 2)] + [any_user])
+    provides = {UserNeed(4), UserNeed(5), any_user, RoleNeed("admin")}
+
+    assert need_set.intersection(provides) == {UserNeed(4), any_user}
+    assert need_set & provides == {UserNeed(4), any_user}
+    assert not need_set.isdisjoint(provides)
+    assert need_set.isdisjoint({UserNeed(5), RoleNeed("admin")})
+
+    other = NeedSet([UserNeed(i) for i in range(0, 100, 3)] + [RoleNeed("admin")])
+    union = need_set.union(other)
+    assert isinstance(union, NeedSet)
+    assert union == set(need_set) | set(other)
+    assert list(union.user_ids) == sorted(set(union.user_ids))
+    assert need_set | other == union
+    assert NeedSet.merge([need_set, {UserNeed(1)}, NeedSet()]) == set(need_set) | {
+        UserNeed(1)
+    }
+
+    assert need_set.difference(other) == set(need_set) - set(other)
+    assert NeedSet([UserNeed(6)]).issubset(need_set)
+    assert need_set.issuperset([UserNeed(6), any_user])
+    assert not need_set.issuperset([UserNeed(7)])
+
+
+def test_action_expansion():
+    """Test that expansions are immutable pairs of need sets."""
+    expansion = ActionExpansion([UserNeed(1), RoleNeed("admin")], [UserNeed(2)])
+    assert isinstance(expansion.needs, NeedSet)
+    assert isinstance(expansion.excludes, NeedSet)
+    assert expansion == ({UserNeed(1), RoleNeed("admin")}, {UserNeed(2)})
+    assert not hasattr(expansion, "__dict__")
+    with pytest.raises(AttributeError):
+        expansion.needs = set()
+    assert pickle.loads(pickle.dumps(expansion)) == expansion
+
+    merged = ActionExpansion.merge([expansion, ActionExpansion([UserNeed(3)])])
+    assert merged == ({UserNeed(1), UserNeed(3), RoleNeed("admin")}, {UserNeed(2)})
+    assert ActionExpansion.from_grants([(False, UserNeed(1)), (True, UserNeed(2))]) == (
+        {UserNeed(1)},
+        {UserNeed(2)},
+    )
+
+
+def test_action_expansion_is_open():
+    """Test the flag of actions granted to all users."""
+    assert ActionExpansion([any_user, UserNeed(1)]).is_open
+    assert ActionExpansion([any_user]).open_needs == {any_user}
+    assert ActionExpansion([authenticated_user]).is_open
+    assert not ActionExpansion([any_user], [UserNeed(1)]).is_open
+    assert not ActionExpansion([UserNeed(1), RoleNeed("admin")]).is_open
+    assert not ActionExpansion().is_open
+
+
+def test_action_expansion_has_excludes():
+    """Test the flag of actions with excludes."""
+    assert ActionExpansion([UserNeed(1)], [RoleNeed("guests")]).has_excludes
+    assert not ActionExpansion([UserNeed(1)]).has_excludes
+
+    merged = ActionExpansion.merge([ActionExpansion([UserNeed(1)])] * 3)
+    assert not merged.has_excludes
+    merged = ActionExpansion.merge(
+        [ActionExpansion([UserNeed(1)]), ActionExpansion([], [UserNeed(2)])]
+    )
+    assert merged.has_excludes and merged.excludes == {UserNeed(2)}
+
+
+def test_permission_needs_are_need_sets(access_app):
+    """Test that the permission needs keep working as sets."""
+    permission = Permission(UserNeed(1), RoleNeed("admin"))
+    permission.explicit_excludes.add(UserNeed(2))
+    assert isinstance(permission.needs, NeedSet)
+    assert permission.needs == {UserNeed(1), RoleNeed("admin")}
+    assert permission.excludes == {UserNeed(2)}
+
+    other = Permission(ParameterizedActionNeed("edit", "1"), UserNeed(3))
+    union = permission.union(other)
+    assert union.needs == set(permission.needs) | set(other.needs)
+    assert permission.difference(other).needs == {UserNeed(1), RoleNeed("admin")}
+    assert permission.reverse().excludes == set(permission.needs)
+    assert Permission(UserNeed(1)).issubset(permission)
+
+    # the expansion is not kept on the permission
+    assert "_permissions" not in vars(permission)
+    identity = Identity(1)
+    identity.provides.add(UserNeed(1))
+    assert permission.allows(identity)
+    identity.provides.add(UserNeed(2))
+    assert not permission.allows(identity)
+
+
+def test_intern_need():
+    """Test that the needs of expansions are shared instances."""
+    assert intern_need(RoleNeed("curator")) is intern_need(RoleNeed("curator"))
+    assert intern_need(UserNeed("system")) is intern_need(UserNeed("system"))
+    assert intern_need(any_user) is any_user
+
+    # user needs are not interned, only their ids are kept
+    need = UserNeed(42)
+    assert intern_need(need) is need
+    assert intern_need(UserNeed(42)) is not need
+    need_set = NeedSet([42, UserNeed(43), RoleNeed("curator")])
+    assert need_set == {UserNeed(42), UserNeed(43), RoleNeed("curator")}
+    assert list(need_set.user_ids) == [42, 43]
+    assert {id(n) for n in need_set.other_needs} == {
+        id(intern_need(RoleNeed("curator")))
+    }
+
+
+class LegacyPermission(Permission):
+    """Permission reading the expansion from the ``_permissions`` attribute."""
+
+    @property
+    def needs(self):
+        """Return the needs of the loaded expansion."""
+        self._load_permissions()
+        return self._permissions.needs
+
+    @property
+    def excludes(self):
+        """Return the excludes of the loaded expansion."""
+        self._load_permissions()
+        return self._permissions.excludes
+
+
+def test_legacy_permissions_attribute(access_app):
+    """Test the subclasses reading the deprecated ``_permissions``."""
+    permission = LegacyPermission(UserNeed(1))
+    permission.explicit_excludes.add(UserNeed(2))
+    identity = Identity(1)
+    identity.provides.add(UserNeed(1))
+    with pytest.deprecated_call():
+        assert permission.needs == {UserNeed(1)}
+        assert permission.allows(identity)
+        identity.provides.add(UserNeed(2))
+        assert not permission.allows(identity)
+    assert "_permissions" not in vars(permission)
+
+    # an expansion set by a subclass is kept
+    permission._permissions = ActionExpansion([UserNeed(3)])
+    assert permission.needs == {UserNeed(3)}
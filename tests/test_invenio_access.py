@@ -4,16 +4,22 @@
 
 """Module tests."""
 
+import threading
+import time
 from importlib.metadata import EntryPoint
 from unittest.mock import patch
 
 import pytest
+import sqlalchemy as sa
+from cachelib import SimpleCache
 from flask import Flask
-from flask_principal import ActionNeed
+from flask_principal import ActionNeed, UserNeed
+from invenio_accounts.models import User
 from invenio_db import db
 from invenio_db.utils import drop_alembic_version_table
 
 from invenio_access import InvenioAccess, current_access
+from invenio_access.models import ActionUsers
 from invenio_access.permissions import SystemRoleNeed
 
 
@@ -124,13 +130,95 @@ def test_alembic(app):
         if db.engine.name == "sqlite":
             raise pytest.skip("Upgrades are not supported on SQLite.")
 
+        def assert_action_indexes():
+            # the included columns are not compared with the metadata
+            if db.engine.name != "postgresql":
+                return
+            inspector = sa.inspect(db.engine)
+            for table in (
+                "access_actionsusers",
+                "access_actionsroles",
+                "access_actionssystemroles",
+            ):
+                (index,) = [
+                    index
+                    for index in inspector.get_indexes(table)
+                    if index["name"] == f"ix_{table}_action_argument"
+                ]
+                assert index["include_columns"] == ["id"]
+
         assert not ext.alembic.compare_metadata()
         db.drop_all()
         drop_alembic_version_table()
         ext.alembic.upgrade()
 
         assert not ext.alembic.compare_metadata()
+        assert_action_indexes()
         ext.alembic.downgrade(target="96e796392533")
         ext.alembic.upgrade()
 
         assert not ext.alembic.compare_metadata()
+        assert_action_indexes()
+
+
+def test_warm_up(app):
+    """Test the action cache warm-up before the first request."""
+    app.config["ACCESS_WARMUP_ACTIONS"] = ["open"]
+    cache = SimpleCache()
+    InvenioAccess(app, cache=cache)
+    with app.app_context():
+        user = User(email="a@inveniosoftware.org")
+        db.session.add(user)
+        db.session.add(ActionUsers(action="open", user=user))
+        db.session.add(ActionUsers(action="open", argument="1", user=user))
+        db.session.commit()
+        cache.clear()
+        user_id = user.id
+
+    @app.route("/")
+    def index():
+        return "ok"
+
+    with app.test_client() as client:
+        assert client.get("/").status_code == 200
+    with app.app_context():
+        assert current_access.warmup_duration is not None
+        assert current_access.get_action_cache("open") == ({UserNeed(user_id)}, set())
+        assert current_access.get_action_cache("open::1") == (
+            {UserNeed(user_id)},
+            set(),
+        )
+        current_access.delete_action_cache("open")
+
+    # the warm-up happens only once
+    with app.test_client() as client:
+        assert client.get("/").status_code == 200
+    with app.app_context():
+        assert current_access.get_action_cache("open") is None
+
+
+def test_warm_up_concurrent_requests(app):
+    """Test that concurrent first requests warm up the cache once."""
+    app.config["ACCESS_WARMUP_ACTIONS"] = ["open"]
+    InvenioAccess(app, cache=SimpleCache())
+    state = app.extensions["invenio-access"]
+    calls = []
+
+    def warm_up():
+        calls.append(None)
+        time.sleep(0.05)
+
+    @app.route("/")
+    def index():
+        return "ok"
+
+    with patch.object(state, "warm_up", warm_up):
+        threads = [
+            threading.Thread(target=lambda: app.test_client().get("/"))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert len(calls) == 1
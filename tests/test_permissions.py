@@ -5,6 +5,7 @@
 """Tests for Permission class."""
 
 import pytest
+import sqlalchemy as sa
 from flask_principal import ActionNeed, Need, RoleNeed, UserNeed
 from invenio_accounts.models import Role, User
 from invenio_db import db
@@ -13,6 +14,7 @@ from invenio_access.models import ActionRoles, ActionSystemRoles, ActionUsers
 from invenio_access.permissions import (
     ParameterizedActionNeed,
     Permission,
+    _expansion_statement,
     any_user,
     authenticated_user,
     superuser_access,
@@ -420,6 +422,22 @@ def test_system_roles(access_app):
     assert permission_write.allows(superuser)
 
 
+def test_open_actions(access_app):
+    """Actions granted to all users still honour the other actions."""
+    user, other = create_users("user", "other")
+    assign_roles({user: [any_user], other: [any_user]})
+
+    act_read = expand(ActionNeed("read"), ("allow", any_user))
+    act_hide = expand(ActionNeed("hide"), ("allow", other), ("deny", user))
+
+    (permission_read,) = create_permissions({"needs": [act_read]})
+    (permission,) = create_permissions({"needs": [act_read, act_hide]})
+
+    assert permission_read.allows(user)
+    assert permission.allows(other)
+    assert not permission.allows(user)
+
+
 def test_allow_by_default(access_app, dynamic_permission):
     """Test that dynamic permissions allows access by default."""
     anonymous, superuser = create_users("anonymous", "superuser")
@@ -434,3 +452,120 @@ def test_allow_by_default(access_app, dynamic_permission):
     superuser = get_superuser()
     assert permission.allows(superuser)
     assert dyn_permission.allows(superuser)
+
+
+def test_compile(access_app):
+    """Test that permissions are compiled once and recompiled if modified."""
+    act_edit = ParameterizedActionNeed("edit", "1")
+    permission = Permission(act_edit, UserNeed(1))
+
+    compiled = permission.compile()
+    assert permission.compile() is compiled
+    assert compiled.explicit == ({UserNeed(1)}, set())
+    assert dict(compiled.actions) == {
+        act_edit: "edit::1",
+        superuser_access: "superuser-access",
+    }
+    assert compiled.action_needs == {act_edit, superuser_access}
+    assert permission.needs == {UserNeed(1)}
+
+    permission.explicit_excludes.add(RoleNeed("guests"))
+    assert permission.compile() is not compiled
+    assert permission.compile().explicit == ({UserNeed(1)}, {RoleNeed("guests")})
+    assert permission.excludes == {RoleNeed("guests")}
+
+
+def test_argument_union_all(access_app):
+    """Test the UNION ALL query of action arguments."""
+    (user,) = create_users("user")
+    (role,) = create_roles("role")
+    assign_roles({user: [role, any_user]})
+    act_edit = ActionNeed("edit")
+    expand(act_edit, ("allow", user, "1"), ("allow", role), ("deny", any_user, "2"))
+    db.session.execute(
+        ActionUsers.__table__.insert(),
+        [
+            {"action": "edit", "exclude": False, "argument": str(i), "user_id": user.id}
+            for i in range(3, 1000)
+        ],
+    )
+    edit_1 = ParameterizedActionNeed("edit", "1")
+
+    def grants(model, union_all):
+        query = model.query_by_action(edit_1, union_all=union_all)
+        return sorted((g.argument or "", g.exclude, str(g.need)) for g in query)
+
+    for model in (ActionUsers, ActionRoles, ActionSystemRoles):
+        assert grants(model, True) == grants(model, False)
+    assert len(grants(ActionUsers, True)) == 1
+
+    def plan(union_all):
+        query = ActionUsers.query_by_action(edit_1, union_all=union_all)
+        sql = query.statement.compile(db.engine, compile_kwargs={"literal_binds": True})
+        rows = db.session.execute(db.text(f"EXPLAIN QUERY PLAN {sql}"))
+        return [row[3] for row in rows]
+
+    if db.engine.name == "sqlite":
+        # each branch of the union uses the action and the argument of the index
+        searches = [step for step in plan(True) if step.startswith("SEARCH")]
+        assert len(searches) == 2
+        assert all("(action=? AND argument=?)" in step for step in searches)
+        assert all("(action=?)" in step for step in plan(False) if "SEARCH" in step)
+
+    for union_all in (True, False):
+        access_app.config["ACCESS_ARGUMENT_UNION_ALL_DIALECTS"] = (
+            [db.engine.name] if union_all else []
+        )
+        permission = Permission(edit_1)
+        assert permission.allows(user)
+        assert not Permission(ParameterizedActionNeed("edit", "2")).allows(user)
+
+
+def test_expansion_statements(access_app):
+    """Test that the expansion queries are built once."""
+    (user,) = create_users("user")
+    (role,) = create_roles("role")
+    act_edit = ActionNeed("edit")
+    expand(act_edit, ("allow", user, "1"), ("deny", role), ("allow", any_user, "1"))
+
+    statement = _expansion_statement(ActionRoles, "role_id", True, False)
+    assert _expansion_statement(ActionRoles, "role_id", True, False) is statement
+
+    for union_all in (True, False):
+        access_app.config["ACCESS_ARGUMENT_UNION_ALL_DIALECTS"] = (
+            [db.engine.name] if union_all else []
+        )
+        permission = Permission(ParameterizedActionNeed("edit", "1"))
+        assert permission.needs == {UserNeed(user.id), any_user}
+        assert permission.excludes == {RoleNeed(role.id)}
+        assert Permission(act_edit).needs == {act_edit, superuser_access}
+
+
+def test_read_engine(access_app, tmp_path):
+    """Test that grants are read from the read engine unless just changed."""
+    replica = sa.create_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+    db.metadata.create_all(replica)
+    with replica.begin() as connection:
+        connection.execute(
+            ActionUsers.__table__.insert(),
+            [{"action": "open", "exclude": False, "user_id": 999}],
+        )
+    access_app.config.update(ACCESS_READ_ENGINE=replica, ACCESS_READ_ENGINE_STALENESS=0)
+    (user,) = create_users("user")
+    act_open = expand(ActionNeed("open"), ("allow", user))
+
+    assert Permission(act_open).needs == {UserNeed(999)}
+
+    # grants changed in the session are read from the primary database
+    access_app.config["ACCESS_READ_ENGINE_STALENESS"] = 60
+    expand(ActionNeed("open"), ("allow", get_superuser()))
+    assert UserNeed(user.id) in Permission(act_open).needs
+
+    access_app.config["ACCESS_READ_ENGINE_STALENESS"] = 0
+    assert Permission(act_open).needs == {UserNeed(999)}
+    db.session.add(ActionUsers(action="open", user_id=user.id, exclude=True))
+    db.session.flush()
+    assert Permission(act_open).excludes == {UserNeed(user.id)}
+    db.session.rollback()
+    assert Permission(act_open).excludes == set()
+    assert Permission(act_open).needs == {UserNeed(999)}
@@ -5,15 +5,35 @@
 """Module tests."""
 
 import time
+import uuid
+from unittest.mock import patch
 
+import sqlalchemy as sa
 from cachelib import SimpleCache
 from flask_principal import ActionNeed, Need, RoleNeed, UserNeed
 from invenio_accounts.models import Role, User
 from invenio_db import db
 
 from invenio_access import InvenioAccess, current_access
-from invenio_access.models import ActionRoles, ActionSystemRoles, ActionUsers
-from invenio_access.permissions import ParameterizedActionNeed, SystemRoleNeed
+from invenio_access.bitsets import BitsetEngine
+from invenio_access.expansions import ActionExpansion, NeedSet
+from invenio_access.models import (
+    AccessChangelog,
+    ActionRoles,
+    ActionSystemRoles,
+    ActionUsers,
+    get_action_cache_key,
+)
+from invenio_access.permissions import (
+    ParameterizedActionNeed,
+    Permission,
+    SystemRoleNeed,
+    any_user,
+    superuser_access,
+    system_identity,
+    system_permission,
+    system_process,
+)
 
 
 class FakeIdentity(object):
@@ -951,3 +971,492 @@ def test_dynamic_permission_needs_cache_invalidation(app, dynamic_permission):
     assert permission_open.needs == set(
         [Need(method="id", value=1), Need(method="id", value=2)]
     )
+
+
+def test_action_cache_stats(app):
+    """Test the action cache counters."""
+    cache = SimpleCache()
+    InvenioAccess(app, cache=cache)
+    current_access.set_action_cache("open", ({UserNeed(1)}, set()))
+    assert current_access.get_action_cache("open") == ({UserNeed(1)}, set())
+    assert current_access.get_action_cache("close") is None
+    assert current_access.get_action_cache_stats() == {
+        "sets": 1,
+        "hits": 1,
+        "misses": 1,
+    }
+
+    app.config["ACCESS_ACTION_CACHE_STATS"] = True
+    current_access.get_many_action_cache(["open", "close", "edit"])
+    current_access.delete_action_cache("open")
+    assert current_access.get_action_cache_stats() == {
+        "hits": 1,
+        "misses": 2,
+        "sets": 0,
+        "deletes": 1,
+    }
+    assert current_access.stats["misses"] == 3
+
+
+def test_bitset_evaluation(app, dynamic_permission):
+    """Test the evaluation of permissions with bitsets."""
+    app.config["ACCESS_BITSET_EVALUATION"] = True
+    InvenioAccess(app, cache=SimpleCache())
+    engine = current_access.bitset_engine
+    assert engine is not None
+
+    user_1 = User(email="user1@inveniosoftware.org")
+    user_2 = User(email="user2@inveniosoftware.org")
+    role = Role(name="role")
+    db.session.add_all([user_1, user_2, role])
+    db.session.flush()
+    db.session.add(ActionUsers(action="open", user=user_1))
+    db.session.add(ActionRoles(action="open", role=role))
+    db.session.flush()
+
+    identity_1 = FakeIdentity(UserNeed(user_1.id))
+    identity_2 = FakeIdentity(UserNeed(user_2.id))
+    identity_role = FakeIdentity(UserNeed(user_2.id), RoleNeed(role.id))
+    permission = Permission(ActionNeed("open"))
+    assert permission.allows(identity_1)
+    assert not permission.allows(identity_2)
+    assert permission.allows(identity_role)
+    assert not Permission(ActionNeed("edit")).allows(identity_1)
+    assert dynamic_permission(ActionNeed("edit")).allows(identity_1)
+    assert Permission(ActionNeed("edit")).allows(FakeIdentity(ActionNeed("edit")))
+    assert Permission(UserNeed(user_2.id)).allows(identity_2)
+
+    # the bitsets are kept in memory until the action is invalidated
+    assert len(engine) == 3
+    current_access.set_action_cache("open", ({UserNeed(user_2.id)}, set()))
+    assert permission.allows(identity_1)
+
+    db.session.add(ActionUsers(action="open", user=user_2))
+    db.session.flush()
+    assert permission.allows(identity_2)
+
+    db.session.add(ActionUsers(action="open", user=user_1, exclude=True))
+    db.session.flush()
+    assert not permission.allows(identity_1)
+    assert permission.allows(identity_2)
+
+    # generations are shared through the cache
+    generation = current_access.get_action_generations(["open"])
+    assert current_access.get_action_generations(["open"]) == generation
+    current_access.delete_action_cache("open")
+    assert current_access.get_action_generations(["open"]) != generation
+
+
+def test_bitset_engine_eviction():
+    """Test that the least recently used bitsets are discarded first."""
+    engine = BitsetEngine(max_size=2)
+    loads = []
+
+    def load(key):
+        def load():
+            loads.append(key)
+            return ActionExpansion([UserNeed(key)])
+
+        return load
+
+    for key in ("a", "b", "a", "c", "a", "b"):
+        engine.get(key, 1, load(key))
+    assert loads == ["a", "b", "c", "b"]
+    assert len(engine) == 2
+
+
+def test_bitset_evaluation_many_users(app, sql_statements):
+    """Test the bitset evaluation of an action granted to many users."""
+    app.config["ACCESS_BITSET_EVALUATION"] = True
+    InvenioAccess(app, cache=SimpleCache())
+    engine = current_access.bitset_engine
+    users = [User(email=f"{i}@inveniosoftware.org") for i in range(500)]
+    db.session.add_all(users)
+    db.session.flush()
+    # every hundredth user is denied
+    denied = {user.id for user in users[99::100]}
+    db.session.execute(
+        ActionUsers.__table__.insert(),
+        [
+            {"action": "open", "exclude": user.id in denied, "user_id": user.id}
+            for user in users
+        ],
+    )
+    permission = Permission(ActionNeed("open"))
+    assert permission.allows(FakeIdentity(UserNeed(users[0].id)))
+
+    # the bitsets hold the expanded needs and excludes
+    key = get_action_cache_key("open", None)
+    generation = current_access.get_action_generations([key])[0]
+    bits = engine.get(key, generation, None)
+    needs = {UserNeed(user.id) for user in users if user.id not in denied}
+    excludes = {UserNeed(user_id) for user_id in denied}
+    assert bits == (engine.index.mask(needs), engine.index.mask(excludes))
+
+    sql_statements.clear()
+    current_access.stats.clear()
+    for user in users:
+        identity = FakeIdentity(UserNeed(user.id))
+        assert permission.allows(identity) == (user.id not in denied)
+    assert not permission.allows(FakeIdentity(UserNeed(0)))
+    # the checks are bitwise operations on the bitsets kept in memory
+    assert not sql_statements and not current_access.stats
+
+
+class CountingCache(SimpleCache):
+    """Cache counting its round trips."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+
+    def _get_many(self, *keys):
+        # the simple cache gets the keys one by one
+        return [super(CountingCache, self).get(key) for key in keys]
+
+    def get(self, key):
+        self.calls.append("get")
+        return super().get(key)
+
+    def get_many(self, *keys):
+        self.calls.append("get_many")
+        return self._get_many(*keys)
+
+
+def test_merged_permission_cache(app):
+    """Test the cache of the merged expansions of permissions."""
+    app.config["ACCESS_MERGED_PERMISSION_CACHE"] = True
+    cache = CountingCache()
+    InvenioAccess(app, cache=cache)
+    user_1 = User(email="user1@inveniosoftware.org")
+    user_2 = User(email="user2@inveniosoftware.org")
+    db.session.add_all([user_1, user_2])
+    db.session.flush()
+    db.session.add(ActionUsers(action="open", user=user_1))
+    db.session.add(ActionUsers(action="edit", user=user_2))
+    db.session.flush()
+
+    permission = Permission(ActionNeed("open"), ActionNeed("edit"))
+    assert permission.needs == {UserNeed(user_1.id), UserNeed(user_2.id)}
+    merged_keys = [k for k in cache._cache if "__merged__::" in k]
+    assert len(merged_keys) == 1
+
+    # the merged expansion is loaded with a single round trip
+    current_access.stats.clear()
+    cache.calls.clear()
+    other = Permission(ActionNeed("edit"), ActionNeed("open"))
+    assert other.allows(FakeIdentity(UserNeed(user_2.id)))
+    assert current_access.stats == {"hits": 1}
+    assert cache.calls == ["get_many"]
+
+    # the explicit needs are not cached with the actions
+    community = Need("community", uuid.uuid4())
+    permission = Permission(ActionNeed("open"), ActionNeed("edit"), community)
+    assert permission.allows(FakeIdentity(community))
+    assert current_access.stats == {"hits": 2}
+    assert [k for k in cache._cache if "__merged__::" in k] == merged_keys
+
+    # a grant change renews the generation of the action
+    db.session.add(ActionUsers(action="edit", user=user_1, exclude=True))
+    db.session.flush()
+    current_access.stats.clear()
+    assert not permission.allows(FakeIdentity(UserNeed(user_1.id)))
+    # only the changed action is expanded again
+    assert current_access.stats == {"misses": 2, "hits": 2, "sets": 2}
+    current_access.stats.clear()
+    assert permission.allows(FakeIdentity(UserNeed(user_2.id)))
+    assert current_access.stats == {"hits": 1}
+
+
+def test_lazy_evaluation(app, sql_statements):
+    """Test that checks stop as soon as an exclude denies access."""
+    InvenioAccess(app, cache=SimpleCache())
+    user = User(email="user@inveniosoftware.org")
+    db.session.add(user)
+    db.session.flush()
+    db.session.add(ActionUsers(action="open", user=user, exclude=True))
+    db.session.add(ActionUsers(action="edit", user=user))
+    db.session.flush()
+    identity = FakeIdentity(UserNeed(user.id))
+
+    sql_statements.clear()
+    # an explicit exclude denies without expanding any action
+    permission = Permission(ActionNeed("edit"))
+    permission.explicit_excludes.add(UserNeed(user.id))
+    current_access.stats.clear()
+    assert not permission.allows(identity)
+    assert not sql_statements and not current_access.stats
+
+    # a cached exclude denies without loading the other actions
+    assert not Permission(ActionNeed("open")).allows(identity)
+    sql_statements.clear()
+    permission = Permission(ActionNeed("open"), ActionNeed("edit"))
+    assert not permission.allows(identity)
+    assert not sql_statements
+    assert current_access.get_action_cache("edit") is None
+
+    assert Permission(ActionNeed("edit")).allows(identity)
+    assert sql_statements
+
+
+def test_open_action_short_circuit(app):
+    """Test that a cached open action allows without any set operation."""
+    InvenioAccess(app, cache=SimpleCache())
+    user = User(email="user@inveniosoftware.org")
+    db.session.add(user)
+    db.session.flush()
+    db.session.add(ActionSystemRoles(action="view", role_name="any_user"))
+    db.session.add(ActionUsers(action="edit", user=user))
+    db.session.add(ActionUsers(action="hide", user=user, exclude=True))
+    db.session.flush()
+    identity = FakeIdentity(UserNeed(user.id), any_user)
+    other = FakeIdentity(UserNeed(user.id + 1), any_user)
+
+    permission = Permission(ActionNeed("view"), ActionNeed("edit"))
+    assert permission.allows(identity)
+    with patch.object(
+        NeedSet, "isdisjoint", autospec=True, side_effect=NeedSet.isdisjoint
+    ) as isdisjoint:
+        assert permission.allows(other)
+    # only the explicit needs are checked
+    assert isdisjoint.call_count == 1
+
+    # excludes of the other actions are still checked
+    permission = Permission(ActionNeed("view"), ActionNeed("hide"))
+    assert not permission.allows(identity)
+    assert permission.allows(other)
+    assert not Permission(ActionNeed("edit")).allows(other)
+
+
+def test_system_process_fast_path(app, sql_statements):
+    """Test that system processes are allowed without any lookup."""
+    InvenioAccess(app, cache=SimpleCache())
+    user = User(email="user@inveniosoftware.org")
+    db.session.add(user)
+    db.session.flush()
+    db.session.add(ActionUsers(action="open", user=user))
+    db.session.flush()
+
+    sql_statements.clear()
+    current_access.stats.clear()
+    assert system_permission.allows(system_identity)
+    assert Permission(ActionNeed("open"), system_process).allows(system_identity)
+    assert not sql_statements and not current_access.stats
+    assert current_access.get_action_cache("open") is None
+
+    # other identities still expand the actions
+    assert Permission(ActionNeed("open")).allows(FakeIdentity(UserNeed(user.id)))
+    assert sql_statements and current_access.stats
+
+    permission = Permission(system_process)
+    permission.explicit_excludes.add(system_process)
+    assert not permission.allows(system_identity)
+
+
+def test_grant_changelog(app):
+    """Test that the ORM events log the changed grants."""
+    InvenioAccess(app, cache=SimpleCache())
+    with app.test_request_context():
+        user = User(email="changelog@inveniosoftware.org")
+        db.session.add(user)
+        db.session.flush()
+        grant = ActionUsers(action="open", argument="1", user=user)
+        db.session.add(grant)
+        db.session.commit()
+        start = AccessChangelog.last_sequence()
+        assert start > 0
+
+        grant = ActionUsers.query.filter_by(action="open", argument="1").one()
+        grant.action, grant.argument = "edit", "2"
+        db.session.commit()
+        db.session.delete(grant)
+        db.session.rollback()
+        db.session.delete(grant)
+        db.session.commit()
+        changes = AccessChangelog.changes_since(start)
+        assert [change[1:] for change in changes] == [
+            ("edit", "2"),
+            ("open", "1"),
+            ("edit", "2"),
+        ]
+        assert [change[0] for change in changes] == sorted(
+            change[0] for change in changes
+        )
+
+
+def test_grant_changelog_owner_deletes(app):
+    """Test that the grants of deleted users and roles are logged."""
+    InvenioAccess(app, cache=SimpleCache())
+    with app.test_request_context():
+        users = [User(email=f"owner{i}@inveniosoftware.org") for i in range(3)]
+        role = Role(name="owner")
+        db.session.add_all(users + [role])
+        db.session.flush()
+        db.session.add(ActionUsers(action="open", user=users[0]))
+        db.session.add(ActionUsers(action="edit", argument="1", user=users[1]))
+        db.session.add(ActionUsers(action="edit", argument="2", user=users[2]))
+        db.session.add(ActionRoles(action="read", role=role))
+        db.session.commit()
+        user_ids = [user.id for user in users]
+
+        def changes(delete):
+            start = AccessChangelog.last_sequence()
+            delete()
+            db.session.commit()
+            return [change[1:] for change in AccessChangelog.changes_since(start)]
+
+        # ORM deletes cascade to the grants
+        assert changes(lambda: db.session.delete(users[0])) == [("open", None)]
+        # bulk deletes leave the grants to the database
+        assert changes(lambda: User.query.filter(User.id == user_ids[1]).delete()) == [
+            ("edit", "1")
+        ]
+        assert changes(
+            lambda: db.session.execute(
+                sa.delete(User.__table__).where(User.id == user_ids[2])
+            )
+        ) == [("edit", "2")]
+        assert changes(lambda: Role.query.filter_by(name="owner").delete()) == [
+            ("read", None)
+        ]
+        assert changes(lambda: Role.query.filter_by(name="owner").delete()) == []
+
+
+def test_grant_replica(app, sql_statements):
+    """Test that actions are expanded from the in-process replica."""
+    app.config.update(
+        ACCESS_REPLICA=True,
+        ACCESS_REPLICA_POLL_INTERVAL=3600,
+        ACCESS_READ_ENGINE_STALENESS=0,
+    )
+    InvenioAccess(app, cache=SimpleCache())
+    user_1 = User(email="user1@inveniosoftware.org")
+    user_2 = User(email="user2@inveniosoftware.org")
+    role = Role(name="role")
+    db.session.add_all([user_1, user_2, role])
+    db.session.flush()
+    db.session.add(ActionUsers(action="open", user=user_1))
+    db.session.add(ActionRoles(action="open", argument="1", role=role))
+    db.session.add(ActionUsers(action="edit", user=user_1, exclude=True))
+    db.session.commit()
+    identity_1 = FakeIdentity(UserNeed(user_1.id))
+    identity_2 = FakeIdentity(UserNeed(user_2.id), RoleNeed(role.id))
+
+    replica = current_access.replica
+    replica.load()
+    assert len(replica) == 3
+
+    sql_statements.clear()
+    current_access.stats.clear()
+    assert Permission(ActionNeed("open")).allows(identity_1)
+    assert not Permission(ActionNeed("open")).allows(identity_2)
+    for identity in (identity_1, identity_2):
+        assert Permission(ParameterizedActionNeed("open", 1)).allows(identity)
+    assert not Permission(ParameterizedActionNeed("open", 2)).allows(identity_2)
+    assert not Permission(ActionNeed("edit")).allows(identity_1)
+    assert Permission(ActionNeed("open")).needs == {UserNeed(user_1.id)}
+    assert not sql_statements and not current_access.stats
+
+    # the changes are applied when the changelog is polled
+    db.session.add(ActionUsers(action="edit", user=user_2))
+    db.session.commit()
+    assert not Permission(ActionNeed("edit")).allows(identity_2)
+    replica.interval = 0
+    assert Permission(ActionNeed("edit")).allows(identity_2)
+    assert replica.sequence == AccessChangelog.last_sequence()
+    assert len(replica) == 4
+
+    # grant changes of the current session are seen immediately
+    replica.interval = 3600
+    app.config["ACCESS_READ_ENGINE_STALENESS"] = 5
+    db.session.delete(ActionUsers.query.filter_by(action="edit", exclude=False).one())
+    db.session.commit()
+    assert not Permission(ActionNeed("edit")).allows(identity_2)
+
+    # uncommitted grant changes are not shared with the replica
+    db.session.add(ActionUsers(action="edit", user=user_2))
+    db.session.flush()
+    assert Permission(ActionNeed("edit")).allows(identity_2)
+    db.session.rollback()
+    assert replica.refresh(force=True) == 1
+    assert not Permission(ActionNeed("edit")).allows(identity_2)
+    assert len(replica) == 3
+
+    # changes committed after changes with a higher sequence are applied
+    sequence = replica.sequence
+    changelog = AccessChangelog.__table__
+    db.session.execute(changelog.insert(), [{"id": sequence + 2, "action": "open"}])
+    db.session.commit()
+    assert replica.refresh(force=True) == 1
+    db.session.execute(
+        ActionUsers.__table__.insert(),
+        [{"action": "late", "exclude": False, "user_id": user_2.id}],
+    )
+    db.session.execute(changelog.insert(), [{"id": sequence + 1, "action": "late"}])
+    db.session.commit()
+    assert replica.refresh(force=True) == 1
+    assert replica.refresh(force=True) == 0
+    assert Permission(ActionNeed("late")).allows(identity_2)
+
+    # grant changes which were not logged are applied by a full reload
+    db.session.execute(
+        ActionUsers.__table__.insert(),
+        [{"action": "unlogged", "exclude": False, "user_id": user_1.id}],
+    )
+    db.session.commit()
+    assert not Permission(ActionNeed("unlogged")).allows(identity_1)
+    replica.reload_interval = 0
+    assert Permission(ActionNeed("unlogged")).allows(identity_1)
+    assert len(replica) == 5
+
+
+def test_grant_replica_errors(app, caplog, sql_statements):
+    """Test that actions are expanded as usual while the replica fails."""
+    app.config.update(
+        ACCESS_REPLICA=True,
+        ACCESS_REPLICA_POLL_INTERVAL=3600,
+        ACCESS_READ_ENGINE_STALENESS=0,
+    )
+    InvenioAccess(app, cache=SimpleCache())
+    user = User(email="user@inveniosoftware.org")
+    db.session.add(user)
+    db.session.flush()
+    db.session.add(ActionUsers(action="open", user=user))
+    db.session.add(ActionUsers(action="edit", user=user))
+    # a grant of a system role which is no longer registered
+    db.session.execute(
+        ActionSystemRoles.__table__.insert(),
+        [{"action": "open", "exclude": True, "role_name": "removed_role"}],
+    )
+    db.session.commit()
+    identity = FakeIdentity(UserNeed(user.id))
+    replica = current_access.replica
+    error = sa.exc.OperationalError("SELECT", {}, Exception("server closed"))
+
+    # the checks fall back to the database until the replica is loaded
+    with patch("invenio_access.replica.connect_read", side_effect=error) as connect:
+        assert Permission(ActionNeed("edit")).allows(identity)
+        assert Permission(ActionNeed("edit")).allows(identity)
+    assert connect.call_count == 1
+    assert replica.sequence is None and replica.failed is not None
+    assert "Grant replica refresh failed." in caplog.text
+
+    assert replica.refresh(force=True) == 0
+    assert replica.failed is None
+    assert "unregistered system roles: removed_role" in caplog.text
+    assert len(replica) == 2
+    sql_statements.clear()
+    assert Permission(ActionNeed("open")).allows(identity)
+    assert not sql_statements
+
+    # and again while the changelog can't be polled
+    db.session.delete(ActionUsers.query.filter_by(action="edit").one())
+    db.session.commit()
+    with patch("invenio_access.replica.connect_read", side_effect=error):
+        assert replica.refresh(force=True) == 0
+        assert not Permission(ActionNeed("edit")).allows(identity)
+    assert replica.refresh(force=True) == 1
+    sql_statements.clear()
+    assert not Permission(ActionNeed("edit")).allows(identity)
+    assert Permission(ActionNeed("open")).allows(identity)
+    assert not sql_statements
@@ -0,0 +1,114 @@
+# SPDX-FileCopyrightText: 2026 CERN.
+# SPDX-License-Identifier: MIT
+
+"""Action cache serializers tests."""
+
+import pickle
+
+import pytest
+from cachelib import SimpleCache
+from flask_principal import RoleNeed, UserNeed
+
+from invenio_access import InvenioAccess, current_access
+from invenio_access.permissions import (
+    ParameterizedActionNeed,
+    any_user,
+    authenticated_user,
+)
+from invenio_access.serializers import (
+    ActionCacheSerializer,
+    CompactActionCacheSerializer,
+)
+
+
+def test_compact_serializer_roundtrip():
+    """Test that the compact serializer restores the needs and excludes."""
+    serializer = CompactActionCacheSerializer()
+    needs = {UserNeed(i) for i in range(1000)} | {
+        RoleNeed("admin"),
+        any_user,
+        UserNeed("system"),
+    }
+    excludes = {UserNeed(2**40), RoleNeed("banned"), authenticated_user}
+
+    value = serializer.dumps((needs, excludes))
+    assert isinstance(value, bytes)
+    assert len(value) < len(pickle.dumps((needs, excludes)))
+    assert serializer.loads(value) == (needs, excludes)
+
+    needs.add(ParameterizedActionNeed("edit", "1"))
+    assert serializer.loads(serializer.dumps((needs, excludes))) == (
+        needs,
+        excludes,
+    )
+    assert serializer.loads(serializer.dumps((set(), set()))) == (set(), set())
+
+
+def test_compact_serializer_ignores_unknown_values():
+    """Test that values of other formats or versions are read as misses."""
+    serializer = CompactActionCacheSerializer()
+    value = serializer.dumps(({UserNeed(1)}, set()))
+
+    class NextSerializer(CompactActionCacheSerializer):
+        VERSION = CompactActionCacheSerializer.VERSION + 1
+
+    assert NextSerializer().loads(value) is None
+    assert serializer.loads(({UserNeed(1)}, set())) is None
+    assert serializer.loads(b"garbage") is None
+
+
+def test_serializer_config(app):
+    """Test that the serializer can be configured."""
+    app.config["ACCESS_ACTION_CACHE_SERIALIZER"] = ActionCacheSerializer
+    cache = SimpleCache()
+    InvenioAccess(app, cache=cache)
+    expansion = ({UserNeed(1)}, {RoleNeed("banned")})
+    current_access.set_action_cache("open", expansion)
+    assert cache.get("Permission::action::open") == expansion
+    assert current_access.get_action_cache("open") == expansion
+
+    current_access.serializer = CompactActionCacheSerializer()
+    assert current_access.get_action_cache("open") is None
+    current_access.set_action_cache("open", expansion)
+    assert isinstance(cache.get("Permission::action::open"), bytes)
+    assert current_access.get_action_cache("open") == expansion
+
+
+def test_compact_serializer_compression():
+    """Test the compression of large entries."""
+    needs = {UserNeed(i) for i in range(10000)}
+    plain = CompactActionCacheSerializer().dumps((needs, set()))
+    assert CompactActionCacheSerializer(compression="zlib").decode(plain)[0] == 0
+
+    for compression in ("zlib", "lzma"):
+        serializer = CompactActionCacheSerializer(
+            compression=compression, compression_threshold=1024
+        )
+        value = serializer.dumps((needs, set()))
+        assert len(value) < len(plain) / 2
+        assert serializer.decode(value)[0] != 0
+        assert serializer.loads(value) == (needs, set())
+        assert serializer.stats["decompressions"] == 2
+        assert serializer.stats["decompressed_bytes"] > len(value)
+
+        # small entries are not compressed
+        small = serializer.dumps(({UserNeed(1)}, set()))
+        assert serializer.decode(small)[0] == 0
+
+    with pytest.raises(ValueError):
+        CompactActionCacheSerializer(compression="unknown")
+
+
+def test_compression_config(app):
+    """Test that the compression is configured from the application."""
+    app.config.update(
+        ACCESS_ACTION_CACHE_COMPRESSION="lzma",
+        ACCESS_ACTION_CACHE_COMPRESSION_THRESHOLD=0,
+    )
+    cache = SimpleCache()
+    InvenioAccess(app, cache=cache)
+    current_access.set_action_cache("open", ({UserNeed(1)}, set()))
+    flags = current_access.serializer.decode(cache.get("Permission::action::open"))[0]
+    assert flags == CompactActionCacheSerializer.FLAG_LZMA
+    assert current_access.get_action_cache("open") == ({UserNeed(1)}, set())
+    assert current_access.get_action_cache_stats()["decompressions"] == 2